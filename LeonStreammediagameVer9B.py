@@ -1,7 +1,15 @@
 import sys
+import argparse
 import os
 import random
 import time
+import math
+import hashlib
+import json
+import threading
+import wave
+import tracemalloc
+from functools import lru_cache
 import numpy as np
 import audioread
 import librosa
@@ -10,9 +18,11 @@ import matplotlib.pyplot as plt
 from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg as FigureCanvas
 from PyQt5.QtWidgets import QApplication, QMainWindow, QWidget, QVBoxLayout, QHBoxLayout, QPushButton, QLabel, QListWidget, QListWidgetItem, QSlider, QStyle, QFrame, QDialog, QProgressBar
 from PyQt5.QtGui import QIcon, QPalette, QColor, QPainter, QImage
-from PyQt5.QtCore import Qt, QTime, QTimer, pyqtSignal, QThread, QObject
+from PyQt5 import sip
+from PyQt5.QtCore import Qt, QRect, QTime, QTimer, pyqtSignal, QObject, QRunnable, QThreadPool
 from pydub import AudioSegment
-from scipy.signal import butter, lfilter
+from scipy.signal import butter, freqz, lfilter, sosfilt, sosfreqz, welch
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 
 # 修正 np.float 和 np.complex 問題
 if not hasattr(np, 'float'):
@@ -20,37 +30,1318 @@ if not hasattr(np, 'float'):
 if not hasattr(np, 'complex'):
     np.complex = np.complex128
 
-# 使用 audioread 讀取音頻文件並提取節奏點
-def load_audio(file_path):
-    y = []
+# 節奏分析使用的取樣率
+ANALYSIS_SR = 22050
+
+# 使用 audioread 解碼成交錯的 int16 PCM，回傳 (samples, channels) 的陣列與取樣率
+# progress 為選用的回呼，傳入已解碼的比例 (0~1)；max_seconds 指定時只解碼開頭的這幾秒
+def decode_pcm(file_path, progress=None, max_seconds=None):
     with audioread.audio_open(file_path) as input_file:
         sr = input_file.samplerate
         n_channels = input_file.channels
+        # 依檔案長度預先配置 int16 緩衝區，直接把每個 frame 的位元組寫進去，
+        # 避免把每個樣本轉成 Python int 物件
+        expected = int(np.ceil(input_file.duration * sr * n_channels)) if input_file.duration else 0
+        limit = int(max_seconds * sr) * n_channels if max_seconds is not None else None
+        if limit is not None:
+            expected = min(expected, limit) if expected else limit
+        pcm = np.empty(max(expected, sr * n_channels), dtype=np.int16)
+        filled = 0
         for frame in input_file:
-            y.extend(np.frombuffer(frame, dtype=np.int16))
-        y = np.array(y, dtype=np.float32)
-        y = y / (2**15)
+            chunk = np.frombuffer(frame, dtype=np.int16)
+            if filled + chunk.size > pcm.size:
+                # 估計長度不足時以倍數成長
+                grown = np.empty(max(pcm.size * 2, filled + chunk.size), dtype=np.int16)
+                grown[:filled] = pcm[:filled]
+                pcm = grown
+            pcm[filled:filled + chunk.size] = chunk
+            filled += chunk.size
+            if progress is not None and expected:
+                progress(filled / expected)
+            if limit is not None and filled >= limit:
+                break
+    return pcm[:filled - filled % n_channels].reshape(-1, n_channels), sr
+
+# 將 decode_pcm 的結果一次轉成 float32 並就地縮放
+# 回傳 (channels, samples) 的陣列；mono=True 時混成單聲道 (samples,)，
+# target_sr 指定時重新取樣到該取樣率
+def pcm_to_float(frames, sr, mono=False, target_sr=None):
+    if mono:
+        y = frames.mean(axis=1, dtype=np.float32)
+    else:
+        y = np.empty((frames.shape[1], frames.shape[0]), dtype=np.float32)
+        y[:] = frames.T
+    y *= 1.0 / (2**15)
+    if target_sr is not None and target_sr != sr:
+        y = librosa.resample(y, orig_sr=sr, target_sr=target_sr)
+        sr = target_sr
     return y, sr
 
-# 圓圈類
-class Circle:
-    def __init__(self, x, y, radius, time_to_show, letter):
-        self.x = x
-        self.y = y
-        self.radius = radius
-        self.time_to_show = time_to_show
-        self.letter = letter
-        self.clicked = False
-
-    def draw(self, screen):
-        if not self.clicked:
-            pygame.draw.circle(screen, (255, 0, 0), (self.x, self.y), self.radius, 2)
-            font = pygame.font.Font(None, 36)
-            text = font.render(self.letter, True, (255, 0, 0))
-            screen.blit(text, (self.x - self.radius // 2, self.y - self.radius // 2))
-
-    def click(self):
-        self.clicked = True
+# 使用 audioread 讀取音頻文件並提取節奏點
+def load_audio(file_path, mono=False, target_sr=None):
+    frames, sr = decode_pcm(file_path)
+    return pcm_to_float(frames, sr, mono=mono, target_sr=target_sr)
+
+def profile_load_audio(file_path, mono=False, target_sr=None):
+    """量測 load_audio 的耗時與峰值記憶體"""
+    tracemalloc.start()
+    start = time.perf_counter()
+    y, sr = load_audio(file_path, mono=mono, target_sr=target_sr)
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"load_audio: {elapsed:.2f} s, peak {peak / 2**20:.1f} MiB, "
+          f"{y.nbytes / 2**20:.1f} MiB output ({y.nbytes and peak / y.nbytes:.2f}x)")
+    return elapsed, peak
+
+# 轉檔快取：以 (路徑, 大小, 修改時間) 的雜湊命名，超過上限時依最近使用時間淘汰
+CACHE_ROOT = os.path.join(os.path.expanduser('~'), '.leonstream')
+WAV_CACHE_DIR = os.path.join(CACHE_ROOT, 'wav')
+WAV_CACHE_MAX_BYTES = 2 * 2**30
+# 快取的 WAV 一律以混音器的取樣率寫出，播放時不必再重新取樣
+PLAYBACK_SR = 44100
+
+def track_cache_key(track_path):
+    stat = os.stat(track_path)
+    key = f"{os.path.abspath(track_path)}|{stat.st_size}|{stat.st_mtime_ns}"
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+def wav_cache_path(track_path):
+    return os.path.join(WAV_CACHE_DIR, f"{track_cache_key(track_path)}-{PLAYBACK_SR}.wav")
+
+def evict_lru(cache_dir, max_bytes, keep=()):
+    """刪除最久未使用的檔案，直到快取目錄小於 max_bytes"""
+    entries = []
+    for entry in os.scandir(cache_dir):
+        if entry.is_file() and not entry.name.endswith('.part'):
+            stat = entry.stat()
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        if path in keep:
+            continue
+        try:
+            os.remove(path)
+            total -= size
+        except OSError:
+            # 檔案可能仍被 pygame 開啟，留待下次淘汰
+            pass
+
+def cached_wav(track_path):
+    """回傳已存在的快取 WAV 路徑，沒有時回傳 None"""
+    wav_path = wav_cache_path(track_path)
+    if os.path.exists(wav_path):
+        os.utime(wav_path)  # 更新使用時間供 LRU 淘汰判斷
+        return wav_path
+    return None
+
+def transcode_to_wav(track_path, frames=None, sr=None, progress=None):
+    """將音樂文件轉換為 WAV 文件，已轉過的直接取用快取
+
+    傳入已解碼的 frames 與 sr 時直接寫出 PCM，不再重新解碼一次。
+    取樣率與 PLAYBACK_SR 不同時在這裡重新取樣一次，之後每次播放都直接讀檔。
+    """
+    wav_path = cached_wav(track_path)
+    if wav_path is not None:
+        return wav_path
+    wav_path = wav_cache_path(track_path)
+    os.makedirs(WAV_CACHE_DIR, exist_ok=True)
+    part_path = f"{wav_path}.{os.getpid()}.{threading.get_ident()}.part"
+    try:
+        if frames is not None:
+            if sr != PLAYBACK_SR:
+                resampled, sr = pcm_to_float(frames, sr, target_sr=PLAYBACK_SR)
+                frames = (np.clip(resampled.T, -1.0, 1.0) * 32767).astype(np.int16)
+            with wave.open(part_path, 'wb') as wav_file:
+                wav_file.setnchannels(frames.shape[1])
+                wav_file.setsampwidth(2)
+                wav_file.setframerate(sr)
+                # 分段寫出以便回報進度（progress 可能因取消而丟出 LoadCancelled）
+                block = sr * 10
+                for start in range(0, frames.shape[0], block):
+                    wav_file.writeframes(frames[start:start + block].astype('<i2', copy=False).tobytes())
+                    if progress is not None:
+                        progress(min(start + block, frames.shape[0]) / frames.shape[0])
+        else:
+            audio = AudioSegment.from_file(track_path).set_frame_rate(PLAYBACK_SR).set_sample_width(2)
+            audio.export(part_path, format='wav')
+    except BaseException:
+        # 寫到一半的檔案不會被 evict_lru 清掉，失敗或取消時直接刪除
+        if os.path.exists(part_path):
+            os.remove(part_path)
+        raise
+    os.replace(part_path, wav_path)
+    evict_lru(WAV_CACHE_DIR, WAV_CACHE_MAX_BYTES, keep=(wav_path,))
+    return wav_path
+
+# 節奏點快取：以音樂文件內容的雜湊與分析參數命名，存成 .npz
+BEAT_CACHE_DIR = os.path.join(CACHE_ROOT, 'beats')
+BEAT_ANALYSIS_PARAMS = {'sr': ANALYSIS_SR, 'hop_length': 512, 'mono': True, 'version': 1}
+content_hashes = {}
+
+def track_content_hash(track_path):
+    # 同一個 (路徑, 大小, 修改時間) 只讀檔計算一次
+    key = track_cache_key(track_path)
+    if key not in content_hashes:
+        digest = hashlib.sha1()
+        with open(track_path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                digest.update(block)
+        content_hashes[key] = digest.hexdigest()
+    return content_hashes[key]
+
+def beat_cache_path(track_path, params=BEAT_ANALYSIS_PARAMS):
+    params_key = hashlib.sha1(repr(sorted(params.items())).encode('utf-8')).hexdigest()[:12]
+    return os.path.join(BEAT_CACHE_DIR, f"{track_content_hash(track_path)}_{params_key}.npz")
+
+def load_beat_map(track_path, params=BEAT_ANALYSIS_PARAMS):
+    """讀取快取的 (tempo, beats)，沒有快取時回傳 None"""
+    path = beat_cache_path(track_path, params)
+    if not os.path.exists(path):
+        return None
+    try:
+        with np.load(path) as data:
+            return data['tempo'], data['beats']
+    except (OSError, ValueError, KeyError):
+        return None
+
+def save_beat_map(track_path, tempo, beats, params=BEAT_ANALYSIS_PARAMS):
+    path = beat_cache_path(track_path, params)
+    os.makedirs(BEAT_CACHE_DIR, exist_ok=True)
+    part_path = f"{path}.{os.getpid()}.{threading.get_ident()}.part"
+    with open(part_path, 'wb') as f:
+        np.savez(f, tempo=np.atleast_1d(tempo), beats=np.asarray(beats, dtype=np.float64))
+    os.replace(part_path, path)
+
+class LoadCancelled(Exception):
+    pass
+
+class CancelToken:
+    """跨執行緒的取消旗標，分析流程在各階段之間呼叫 check()"""
+    def __init__(self):
+        self.event = threading.Event()
+
+    def cancel(self):
+        self.event.set()
+
+    def cancelled(self):
+        return self.event.is_set()
+
+    def check(self):
+        if self.event.is_set():
+            raise LoadCancelled()
+
+class ProgressReporter:
+    """把各階段的進度換算成 0~100 的整數，並限制回呼的頻率
+
+    有 cancel 時每次回報進度都會檢查是否已被取消。
+    """
+    def __init__(self, callback, min_interval=0.1, cancel=None):
+        self.callback = callback
+        self.min_interval = min_interval
+        self.cancel = cancel
+        self.last_value = -1
+        self.last_time = 0.0
+
+    def stage(self, start, end):
+        # 回傳一個把階段內比例 (0~1) 對應到 [start, end] 的回呼
+        def report(fraction):
+            self.report(start + (end - start) * min(max(fraction, 0.0), 1.0))
+        return report
+
+    def report(self, value):
+        if self.cancel is not None:
+            self.cancel.check()
+        value = int(value)
+        if self.callback is None or value <= self.last_value:
+            return
+        now = time.perf_counter()
+        if value < 100 and now - self.last_time < self.min_interval:
+            return
+        self.last_value = value
+        self.last_time = now
+        self.callback(value)
+
+def onset_strength_frames(y, sr, start, stop, hop_length=512, n_fft=2048):
+    """計算 beat_track 使用的 onset 包絡中 [start, stop) 的 frame，結果與整首一次計算相同"""
+    margin = 8  # 前後多取的 frame 數，蓋過 STFT 視窗與差分的邊界效應
+    lead = min(start, margin)
+    segment = y[(start - lead) * hop_length:(stop + margin) * hop_length + n_fft]
+    chunk = librosa.onset.onset_strength(y=segment, sr=sr, hop_length=hop_length, n_fft=n_fft, aggregate=np.median)
+    return chunk[lead:lead + stop - start]
+
+def onset_strength_chunked(y, sr, hop_length=512, n_fft=2048, chunk_frames=2048, progress=None):
+    """分段計算 onset 包絡以便回報進度"""
+    n_frames = 1 + len(y) // hop_length
+    envelope = np.empty(n_frames, dtype=np.float32)
+    for start in range(0, n_frames, chunk_frames):
+        stop = min(start + chunk_frames, n_frames)
+        envelope[start:stop] = onset_strength_frames(y, sr, start, stop, hop_length, n_fft)
+        if progress is not None:
+            progress(stop / n_frames)
+    return envelope
+
+# 漸進式分析：先分析開頭幾秒讓遊戲馬上開始，之後每段的節奏點再陸續補上
+PREVIEW_SECONDS = 10.0
+STREAM_CHUNK_SECONDS = 20.0
+STREAM_OVERLAP_SECONDS = 8.0  # 每段往前多看的長度，讓節奏追蹤能接上前一段
+PREVIEW_LOOKAHEAD_SECONDS = 1.0  # 預覽多解碼的長度，涵蓋 onset 包絡在段尾需要的樣本
+STREAM_GUARD_SECONDS = 2.0    # 每段結尾不採用的長度，beat_track 會修剪邊界上的弱拍
+
+def progressive_beat_track(y, sr, on_beats, hop_length=512, progress=None, load_rest=None):
+    """分段追蹤節奏點，每段新的節奏點（秒）交給 on_beats(tempo, beats)，回傳完整的 onset 包絡
+
+    有 load_rest 時 y 只是開頭的預覽片段：送出第一段節奏點後才呼叫 load_rest() 取得整首音訊。
+    """
+    n_frames = 1 + len(y) // hop_length
+    frames_per_second = sr / hop_length
+    overlap = int(STREAM_OVERLAP_SECONDS * frames_per_second)
+    guard = int(STREAM_GUARD_SECONDS * frames_per_second)
+    envelope = np.empty(n_frames, dtype=np.float32)
+    computed = 0
+    accepted = 0
+    stop = min(n_frames, int(PREVIEW_SECONDS * frames_per_second))
+    tempo = None
+    last_beat = -np.inf
+    while accepted < n_frames:
+        if stop > computed:
+            envelope[computed:stop] = onset_strength_frames(y, sr, computed, stop, hop_length)
+        computed = stop
+        start = max(0, accepted - overlap)
+        # 第一個估出有效速度的段落作為之後各段的先驗；開頭靜音時速度為 0，下一段重新估計
+        prior = {} if tempo is None else {'start_bpm': float(np.atleast_1d(tempo)[0])}
+        window_tempo, window_beats = librosa.beat.beat_track(onset_envelope=envelope[start:stop], sr=sr,
+                                                             hop_length=hop_length, units='frames', **prior)
+        if tempo is None and float(np.atleast_1d(window_tempo)[0]) > 0:
+            tempo = window_tempo
+        current_tempo = tempo if tempo is not None else window_tempo
+        limit = stop if stop == n_frames and load_rest is None else max(accepted, stop - guard)
+        window_beats = window_beats + start
+        new_frames = window_beats[(window_beats >= accepted) & (window_beats < limit)]
+        beats = librosa.frames_to_time(new_frames, sr=sr, hop_length=hop_length)
+        # 去掉與上一段最後一拍太接近的重複拍點
+        min_gap = 30.0 / max(float(np.atleast_1d(current_tempo)[0]), 1.0)
+        beats = beats[beats > last_beat + min_gap]
+        if len(beats):
+            last_beat = beats[-1]
+        accepted = limit
+        on_beats(current_tempo, beats)
+        if load_rest is not None:
+            # 預覽已送出，接著取得整首音訊，已算好的包絡保留
+            y = load_rest()
+            load_rest = None
+            n_frames = 1 + len(y) // hop_length
+            envelope = np.concatenate([envelope[:computed], np.empty(n_frames - computed, dtype=np.float32)])
+        if progress is not None:
+            progress(computed / n_frames)
+        stop = min(n_frames, computed + int(STREAM_CHUNK_SECONDS * frames_per_second))
+    return envelope
+
+def analyze_track(track_path, use_cache=True, progress=None, cancel=None, on_beats=None, transcode=True):
+    """分析一首曲目並把節奏點與 WAV 寫入快取，可在子行程中執行
+
+    use_cache=False 時忽略已有的節奏點快取；
+    transcode=False 時只分析節奏點，不寫播放用的 WAV（wav_path 為 None）；
+    progress 會收到 0~100 的整體進度；cancel 被取消時拋出 LoadCancelled。
+    有 on_beats 時先只解碼開頭 PREVIEW_SECONDS 秒送出預覽節奏點（此時 WAV 還沒寫出，
+    wav_path 為原始檔案），之後才解碼整首、寫出 WAV 並分段送出其餘節奏點，
+    每段以 on_beats(tempo, beats, wav_path) 送出；快取命中時一次送出全部節奏點。
+    """
+    track_start = time.perf_counter()
+    reporter = ProgressReporter(progress, cancel=cancel)
+    result = {'track': track_path, 'cached': False, 'duration': 0.0, 'decode_s': 0.0, 'analysis_s': 0.0, 'transcode_s': 0.0, 'first_beats_s': None}
+    wav_path = wav_cache_path(track_path) if transcode else None
+
+    def write_wav(frames=None, native_sr=None):
+        start = time.perf_counter()
+        path = wav_path
+        try:
+            if frames is not None:
+                path = transcode_to_wav(track_path, frames, native_sr, progress=reporter.stage(40, 50))
+            else:
+                path = transcode_to_wav(track_path)
+        except PermissionError:
+            print(f"Permission denied: '{wav_path}'")
+        result['transcode_s'] = time.perf_counter() - start
+        return path
+
+    def decode_full():
+        # 只解碼一次，同一份 PCM 同時供節奏分析與播放用的 WAV 使用
+        nonlocal wav_path
+        start = time.perf_counter()
+        frames, native_sr = decode_pcm(track_path, progress=reporter.stage(0, 40))
+        y, _ = pcm_to_float(frames, native_sr, mono=True, target_sr=ANALYSIS_SR)
+        result['decode_s'] += time.perf_counter() - start
+        result['duration'] = frames.shape[0] / native_sr
+        reporter.report(40)
+        if transcode:
+            wav_path = write_wav(frames, native_sr)
+        reporter.report(50)
+        return y
+
+    # 已分析過的曲目直接讀取節奏點，不需要解碼
+    cached = load_beat_map(track_path) if use_cache else None
+    if cached is not None:
+        if transcode:
+            wav_path = write_wav()
+        reporter.report(50)
+        tempo, beats = cached
+        result['cached'] = True
+        if on_beats is not None:
+            on_beats(tempo, beats, wav_path)
+    else:
+        start = time.perf_counter()
+        sr = ANALYSIS_SR
+        hop_length = BEAT_ANALYSIS_PARAMS['hop_length']
+        if on_beats is not None:
+            # 預覽只需要開頭幾秒，不等整首解碼；WAV 還沒寫出前先以原始檔案播放
+            head, native_sr = decode_pcm(track_path, max_seconds=PREVIEW_SECONDS + PREVIEW_LOOKAHEAD_SECONDS)
+            y, _ = pcm_to_float(head, native_sr, mono=True, target_sr=ANALYSIS_SR)
+            result['decode_s'] = time.perf_counter() - start
+            play_path = (cached_wav(track_path) if transcode else None) or track_path
+
+            def emit(tempo, beats):
+                if result['first_beats_s'] is None:
+                    result['first_beats_s'] = time.perf_counter() - track_start
+                    on_beats(tempo, beats, play_path)
+                else:
+                    on_beats(tempo, beats, wav_path)
+
+            onset_envelope = progressive_beat_track(y, sr, emit, hop_length=hop_length,
+                                                    progress=reporter.stage(50, 95), load_rest=decode_full)
+        else:
+            y = decode_full()
+            onset_envelope = onset_strength_chunked(y, sr, hop_length=hop_length, progress=reporter.stage(50, 95))
+        # 快取中存的一律是整首一次追蹤的結果
+        tempo, beats = librosa.beat.beat_track(onset_envelope=onset_envelope, sr=sr, hop_length=hop_length, units='time')
+        result['analysis_s'] = time.perf_counter() - start - result['decode_s'] - result['transcode_s']
+        save_beat_map(track_path, tempo, beats)
+    reporter.report(100)
+    result['total_s'] = time.perf_counter() - track_start
+    result.update(tempo=tempo, beats=beats, wav_path=wav_path)
+    return result
+
+def warm_up_analysis():
+    """以一段雜訊先跑一次重新取樣、onset 與節奏追蹤，讓 numba 編譯等首次成本不落在第一次載入"""
+    noise = (np.random.default_rng(0).standard_normal((ANALYSIS_SR * 2, 1)) * 3000).astype(np.int16)
+    y, sr = pcm_to_float(noise.repeat(2, axis=0), ANALYSIS_SR * 2, mono=True, target_sr=ANALYSIS_SR)
+    envelope = onset_strength_frames(y, sr, 0, 1 + len(y) // 512)
+    librosa.beat.beat_track(onset_envelope=envelope, sr=sr, hop_length=512)
+
+# 每隔幾個節奏點產生一個圓圈
+CHART_BEAT_STRIDE = 5
+CHART_DIR = os.path.join(CACHE_ROOT, 'charts')
+AUDIO_EXTENSIONS = ('.mp3',)
+
+def find_audio_files(folder, extensions=AUDIO_EXTENSIONS):
+    music_files = []
+    for root, _, files in os.walk(folder):
+        for file in sorted(files):
+            if file.lower().endswith(extensions):
+                music_files.append(os.path.join(root, file))
+    return music_files
+
+def save_chart(result, out_dir, folder):
+    # 依曲目在 folder 中的相對路徑命名，不同子資料夾的同名曲目不會互相覆蓋
+    name = os.path.splitext(os.path.relpath(result['track'], folder))[0]
+    chart_path = os.path.join(out_dir, name + '.npz')
+    os.makedirs(os.path.dirname(chart_path), exist_ok=True)
+    beats = np.asarray(result['beats'], dtype=np.float64)
+    np.savez(chart_path, tempo=np.atleast_1d(result['tempo']), beats=beats,
+             chart=beats[::CHART_BEAT_STRIDE])
+    return chart_path
+
+def analyze_library(folder, out_dir=CHART_DIR, workers=None, use_cache=True, extensions=AUDIO_EXTENSIONS,
+                    transcode=False):
+    """不開視窗，以多個行程分析整個資料夾並輸出譜面，回傳每首曲目的結果
+
+    預設只分析節奏點；transcode=True 時也把播放用的 WAV 寫進快取。
+    """
+    tracks = find_audio_files(folder, extensions)
+    if not tracks:
+        print(f"No audio files found in {folder}")
+        return []
+    os.makedirs(out_dir, exist_ok=True)
+    workers = workers or os.cpu_count() or 1
+    print(f"Analyzing {len(tracks)} tracks with {workers} workers")
+    results = []
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(analyze_track, track, use_cache=use_cache, transcode=transcode): track for track in tracks}
+        for future in as_completed(futures):
+            track = futures[future]
+            try:
+                result = future.result()
+            except Exception as error:
+                print(f"FAILED  {os.path.basename(track)}: {error}")
+                continue
+            save_chart(result, out_dir, folder)
+            results.append(result)
+            print(f"{'cached' if result['cached'] else 'done':7s} {os.path.basename(track)}: "
+                  f"{result['duration']:.1f}s audio, decode {result['decode_s']:.2f}s, "
+                  f"analysis {result['analysis_s']:.2f}s, transcode {result['transcode_s']:.2f}s, "
+                  f"total {result['total_s']:.2f}s, {len(result['beats'])} beats")
+    elapsed = time.perf_counter() - start
+    audio_seconds = sum(result['duration'] for result in results)
+    print(f"{len(results)}/{len(tracks)} tracks in {elapsed:.1f}s: "
+          f"{len(results) / elapsed * 60:.1f} tracks/min, "
+          f"{audio_seconds / elapsed:.1f} audio-seconds/sec (decoded tracks only)")
+    return results
+
+# 等化器：九個頻段中心頻率（Hz）與 peaking 濾波器的 Q（約一個八度的頻寬）
+EQ_FREQUENCIES = (75, 150, 300, 600, 1200, 2400, 4800, 9600, 19200)
+EQ_Q = 1.414
+# 即時等化時每次送進聲道的區塊長度（取樣數）
+EQ_BLOCK = 1024
+# 離線等化切成的時間區段，以及每段前面多濾的暖機長度（秒），讓從零開始的濾波器狀態先收斂
+EQ_CHUNK_SECONDS = 5.0
+EQ_WARMUP_SECONDS = 0.5
+# FFT 等化的 FIR 長度、FFT 長度與每次一起轉換的區塊數
+EQ_FIR_TAPS = 4096
+EQ_FFT_SIZE = 16384
+EQ_FFT_BATCH = 32
+
+@lru_cache(maxsize=64)
+def peaking_eq_sos(sr, gains, freqs=EQ_FREQUENCIES, q=EQ_Q, flat_bands=False):
+    """依 RBJ Audio EQ Cookbook 設計 peaking 濾波器組，回傳 sosfilt 用的 (n, 6) 係數
+
+    中心頻率不低於 Nyquist 的頻段不產生 section；增益為 0 dB 的頻段預設也略過，
+    flat_bands=True 時保留為直通 section，讓 section 數固定、串流的濾波器狀態可以沿用。
+    gains 需為 tuple 才能快取。
+    """
+    sections = []
+    for freq, gain in zip(freqs, gains):
+        if freq >= sr / 2 or (gain == 0 and not flat_bands):
+            continue
+        amplitude = 10 ** (gain / 40)
+        w0 = 2 * np.pi * freq / sr
+        alpha = np.sin(w0) / (2 * q)
+        cos_w0 = np.cos(w0)
+        b = np.array([1 + alpha * amplitude, -2 * cos_w0, 1 - alpha * amplitude])
+        a = np.array([1 + alpha / amplitude, -2 * cos_w0, 1 - alpha / amplitude])
+        sections.append(np.concatenate([b, a]) / a[0])
+    # 回傳的陣列由快取共用，呼叫端不可修改
+    return np.array(sections).reshape(-1, 6)
+
+def equalize(y, sr, gains, freqs=EQ_FREQUENCIES):
+    """以 peaking 濾波器組一次處理整段訊號（最後一軸為時間），所有增益為 0 時直接回傳原訊號"""
+    sos = peaking_eq_sos(sr, tuple(float(gain) for gain in gains), tuple(freqs))
+    if not len(sos):
+        return y
+    return sosfilt(sos, y, axis=-1).astype(y.dtype, copy=False)
+
+def equalize_parallel(y, sr, gains, freqs=EQ_FREQUENCIES, workers=None,
+                      chunk_seconds=EQ_CHUNK_SECONDS, warmup_seconds=EQ_WARMUP_SECONDS):
+    """離線等化：把每個聲道切成時間區段交給執行緒池處理（sosfilt 執行時會釋放 GIL）
+
+    每段從前面 warmup_seconds 開始濾波再丟掉暖機部分，與整段一次處理的差異遠低於 16-bit 的解析度。
+    """
+    sos = peaking_eq_sos(sr, tuple(float(gain) for gain in gains), tuple(freqs))
+    if not len(sos):
+        return y
+    x = y.reshape(-1, y.shape[-1])
+    out = np.empty(x.shape, dtype=y.dtype)
+    chunk = max(1, int(chunk_seconds * sr))
+    warmup = int(warmup_seconds * sr)
+
+    def render(channel, start):
+        begin = max(0, start - warmup)
+        filtered = sosfilt(sos, x[channel, begin:start + chunk])
+        out[channel, start:start + chunk] = filtered[start - begin:]
+
+    jobs = [(channel, start) for channel in range(x.shape[0]) for start in range(0, x.shape[1], chunk)]
+    with ThreadPoolExecutor(max_workers=workers or os.cpu_count() or 1) as executor:
+        for future in [executor.submit(render, channel, start) for channel, start in jobs]:
+            future.result()
+    return out.reshape(y.shape)
+
+@lru_cache(maxsize=16)
+def fir_spectrum(sr, gains, freqs=EQ_FREQUENCIES, taps=EQ_FIR_TAPS, fft_size=EQ_FFT_SIZE):
+    """以 peaking 濾波器組的振幅響應設計線性相位 FIR，回傳長度 fft_size 的 rfft 頻譜
+
+    FIR 延遲 taps // 2 個取樣，由 equalize_fft 扣掉。
+    """
+    sos = peaking_eq_sos(sr, gains, freqs)
+    grid = np.fft.rfftfreq(taps, 1 / sr)
+    magnitude = np.abs(sosfreqz(sos, worN=grid, fs=sr)[1]) if len(sos) else np.ones(len(grid))
+    fir = np.roll(np.fft.irfft(magnitude, taps), taps // 2) * np.hanning(taps)
+    return np.fft.rfft(fir.astype(np.float32), fft_size)
+
+def equalize_fft(y, sr, gains, freqs=EQ_FREQUENCIES, taps=EQ_FIR_TAPS, fft_size=EQ_FFT_SIZE):
+    """以 FFT overlap-add 套用九個頻段合成的頻率響應（只比對振幅，相位為線性）"""
+    gains = tuple(float(gain) for gain in gains)
+    if not any(gains):
+        return y
+    spectrum = fir_spectrum(sr, gains, tuple(freqs), taps, fft_size)
+    x = y.reshape(-1, y.shape[-1]).astype(np.float32, copy=False)
+    channels, length = x.shape
+    hop = fft_size - taps + 1
+    delay = taps // 2
+    blocks = -(-(length + delay) // hop)
+    padded = np.zeros((channels, blocks * hop), dtype=np.float32)
+    padded[:, :length] = x
+    out = np.zeros((channels, (blocks + 1) * hop), dtype=np.float32)
+    tail = fft_size - hop
+    for first in range(0, blocks, EQ_FFT_BATCH):
+        count = min(EQ_FFT_BATCH, blocks - first)
+        segments = padded[:, first * hop:(first + count) * hop].reshape(channels, count, hop)
+        filtered = np.fft.irfft(np.fft.rfft(segments, fft_size) * spectrum, fft_size)
+        # 每個區塊的前 hop 個取樣接在自己的位置，後面 taps - 1 個取樣疊加到下一個區塊開頭
+        out[:, first * hop:(first + count) * hop] += filtered[:, :, :hop].reshape(channels, -1)
+        overlap = np.zeros((channels, count, hop), dtype=np.float32)
+        overlap[:, :, :tail] = filtered[:, :, hop:]
+        out[:, (first + 1) * hop:(first + count + 1) * hop] += overlap.reshape(channels, -1)
+    return out[:, delay:delay + length].astype(y.dtype, copy=False).reshape(y.shape)
+
+# 離線等化的實作，render 以 --backend 選擇
+EQ_BACKENDS = {'iir': equalize_parallel, 'fft': equalize_fft}
+
+def render_equalized(input_path, output_path, gains, workers=None, backend='iir'):
+    """以 EQ_BACKENDS 中的 backend 離線等化整首曲目並寫成 16-bit WAV，回傳各階段耗時
+
+    workers 只用於 iir（分段多執行緒）。
+    """
+    timings = {}
+    start = time.perf_counter()
+    frames, sr = decode_pcm(input_path)
+    y, sr = pcm_to_float(frames, sr)
+    timings['decode_s'] = time.perf_counter() - start
+    start = time.perf_counter()
+    if backend == 'iir':
+        y = equalize_parallel(y, sr, gains, workers=workers)
+    else:
+        y = EQ_BACKENDS[backend](y, sr, gains)
+    timings['equalize_s'] = time.perf_counter() - start
+    start = time.perf_counter()
+    with wave.open(output_path, 'wb') as wav_file:
+        wav_file.setnchannels(y.shape[0])
+        wav_file.setsampwidth(2)
+        wav_file.setframerate(sr)
+        wav_file.writeframes((np.clip(y.T, -1.0, 1.0) * 32767).astype('<i2').tobytes())
+    timings['write_s'] = time.perf_counter() - start
+    duration = y.shape[-1] / sr
+    print(f"Rendered {os.path.basename(input_path)} -> {output_path} ({backend}): {duration:.1f}s audio, "
+          f"decode {timings['decode_s']:.2f}s, equalize {timings['equalize_s']:.2f}s "
+          f"({duration / max(timings['equalize_s'], 1e-9):.0f}x realtime), write {timings['write_s']:.2f}s")
+    return timings
+
+def butter_equalizer(y, freqs, gains, sr):
+    """舊的串聯帶通實作（每個頻段都乘在整段訊號上），只留給 bench eq 比較"""
+    for freq, gain in zip(freqs, gains):
+        if gain != 0:
+            low = freq / np.sqrt(2)
+            high = freq * np.sqrt(2)
+            b, a = butter(2, [low / (0.5 * sr), high / (0.5 * sr)], btype='band')
+            y = lfilter(b, a, y) * (10 ** (gain / 20))
+    return y
+
+def benchmark_eq(file_path=None, seconds=30.0, gains=(6, 0, -4, 0, 3, 0, 0, -6, 0), repeats=3):
+    """比較舊的 butter/lfilter 串聯與 peaking EQ sosfilt 的處理速度與頻段中心的增益誤差"""
+    if file_path:
+        y, sr = load_audio(file_path)
+    else:
+        sr = 44100
+        y = (np.random.default_rng(0).standard_normal((2, int(seconds * sr))) * 0.1).astype(np.float32)
+    audio_seconds = y.shape[-1] / sr
+    print(f"{y.shape[0]} channels, {audio_seconds:.1f}s at {sr} Hz, gains {gains}")
+
+    peaking_eq_sos.cache_clear()
+    start = time.perf_counter()
+    peaking_eq_sos(sr, tuple(float(gain) for gain in gains))
+    cold = time.perf_counter() - start
+    start = time.perf_counter()
+    sos = peaking_eq_sos(sr, tuple(float(gain) for gain in gains))
+    print(f"coefficient design: {cold * 1e6:.0f} us, cached {(time.perf_counter() - start) * 1e6:.1f} us, "
+          f"{len(sos)} sections")
+
+    for name, run in (('butter/lfilter', lambda: butter_equalizer(y, EQ_FREQUENCIES, gains, sr)),
+                      ('peaking sos', lambda: equalize(y, sr, gains))):
+        times = []
+        for _ in range(repeats):
+            start = time.perf_counter()
+            out = run()
+            times.append(time.perf_counter() - start)
+        best = min(times)
+        print(f"{name:15s}: {best * 1e3:8.1f} ms, {audio_seconds / best:7.0f}x realtime, "
+              f"output finite {bool(np.isfinite(out).all())}")
+
+    # 頻段中心實際增益與滑桿設定的差距；舊實作每個帶通都乘在整段訊號上，0 dB 的頻段也會被衰減
+    centers = np.array([freq for freq in EQ_FREQUENCIES if freq < sr / 2], dtype=float)
+    target = np.array(gains[:len(centers)], dtype=float)
+    old = np.ones(len(centers), dtype=complex)
+    for freq, gain in zip(centers, gains):
+        if gain != 0:
+            b, a = butter(2, [freq / np.sqrt(2) / (0.5 * sr), freq * np.sqrt(2) / (0.5 * sr)], btype='band')
+            old *= freqz(b, a, worN=centers, fs=sr)[1] * 10 ** (gain / 20)
+    new = sosfreqz(sos, worN=centers, fs=sr)[1] if len(sos) else np.ones(len(centers))
+    for name, response in (('butter/lfilter', old), ('peaking sos', new)):
+        error = 20 * np.log10(np.maximum(np.abs(response), 1e-12)) - target
+        print(f"{name:15s}: band-center error max {np.abs(error).max():6.1f} dB, "
+              f"rms {np.sqrt(np.mean(error ** 2)):6.1f} dB")
+
+def benchmark_eq_backends(file_path=None, seconds=180.0, gains=(6, 0, -4, 0, 3, 0, 0, -6, 0), repeats=3):
+    """比較 IIR 與 FFT 兩種離線等化的速度，以及實測頻譜與 peaking 濾波器組設計響應的差距"""
+    if file_path:
+        y, sr = load_audio(file_path)
+    else:
+        sr = 44100
+        y = (np.random.default_rng(0).standard_normal((2, int(seconds * sr))) * 0.1).astype(np.float32)
+    audio_seconds = y.shape[-1] / sr
+    print(f"{y.shape[0]} channels, {audio_seconds:.1f}s at {sr} Hz, gains {gains}")
+
+    # 以 Welch 法量測輸出/輸入的功率比，與設計響應比較 30 Hz 到 16 kHz 的誤差
+    freqs, input_psd = welch(y[0], sr, nperseg=8192)
+    band = (freqs >= 30) & (freqs <= min(16000, sr / 2))
+    sos = peaking_eq_sos(sr, tuple(float(gain) for gain in gains))
+    target = 20 * np.log10(np.abs(sosfreqz(sos, worN=freqs[band], fs=sr)[1]))
+    for name, backend in EQ_BACKENDS.items():
+        backend(y[:, :sr], sr, gains)  # 先建好快取的係數
+        best = min(timed(lambda: backend(y, sr, gains)) for _ in range(repeats))
+        out = backend(y, sr, gains)
+        measured = 10 * np.log10(welch(out[0], sr, nperseg=8192)[1][band] / input_psd[band])
+        error = measured - target
+        print(f"{name:4s}: {best * 1e3:8.1f} ms, {audio_seconds / best:6.0f}x realtime, "
+              f"response error max {np.abs(error).max():.2f} dB, rms {np.sqrt(np.mean(error ** 2)):.2f} dB")
+
+def benchmark_stream(file_path, seconds=3.0):
+    """以 EqualizerStream 實際播放一段曲目，檢查開檔耗時、播放位置與區塊是否來得及補上"""
+    app = QApplication.instance() or QApplication(sys.argv[:1])
+    pygame.mixer.init(frequency=PLAYBACK_SR)
+    pygame.mixer.set_reserved(1)
+    start = time.perf_counter()
+    wav_path = transcode_to_wav(file_path)
+    print(f"transcode {time.perf_counter() - start:.2f}s (cached after the first run)")
+    start = time.perf_counter()
+    stream = EqualizerStream(wav_path, [0] * len(EQ_FREQUENCIES))
+    print(f"open {(time.perf_counter() - start) * 1e3:.1f} ms, mixer {stream.sr} Hz, "
+          f"{stream.duration:.1f}s, {stream.source_channels} -> {stream.channels} channels")
+    stream.play()
+    QTimer.singleShot(int(seconds * 1000), app.quit)
+    app.exec_()
+    print(f"played {seconds:.1f}s: position {stream.tell():.2f}s, underruns {stream.underruns}")
+    stream.stop()
+    pygame.mixer.quit()
+
+def benchmark_first_notes(file_path):
+    """量測從開始載入到第一段節奏點送出（遊戲可以開始）的時間，分別在暖機前後各跑一次"""
+    for label in ('cold', 'warm'):
+        result = analyze_track(file_path, use_cache=False, transcode=False, on_beats=lambda *args: None)
+        print(f"{label}: first notes after {result['first_beats_s']:.2f}s, full analysis {result['total_s']:.2f}s "
+              f"for {result['duration']:.0f}s of audio")
+
+def check_progressive_beats(silence_seconds=12.0, seconds=90.0, bpm=120.0):
+    """以開頭有一段靜音的節拍音軌比較漸進式與整首一次追蹤的節奏點數量與最大間隔"""
+    sr = ANALYSIS_SR
+    rng = np.random.default_rng(0)
+    y = np.zeros(int(seconds * sr), dtype=np.float32)
+    click = (rng.standard_normal(2000) * np.exp(-np.arange(2000) / 300) * 0.5).astype(np.float32)
+    for t in np.arange(silence_seconds, seconds - 0.1, 60.0 / bpm):
+        y[int(t * sr):int(t * sr) + len(click)] += click
+    chunks = []
+    envelope = progressive_beat_track(y, sr, lambda tempo, beats: chunks.append(beats))
+    progressive = np.concatenate(chunks)
+    _, full = librosa.beat.beat_track(onset_envelope=envelope, sr=sr, hop_length=512, units='time')
+    audible = progressive[progressive > silence_seconds + 1]
+    gap = np.diff(audible).max() if len(audible) > 1 else float('inf')
+    print(f"{silence_seconds:.0f}s leading silence: progressive {len(progressive)} beats, full {len(full)} beats, "
+          f"largest gap after the silence {gap:.2f}s (expected {60.0 / bpm:.2f}s)")
+    return gap
+
+def timed(run):
+    start = time.perf_counter()
+    run()
+    return time.perf_counter() - start
+
+def benchmark_eq_render(file_path=None, seconds=180.0, gains=(6, 0, -4, 0, 3, 0, 0, -6, 0),
+                        workers=(1, 2, 4, 8), repeats=3):
+    """量測離線等化在不同執行緒數下的速度、相對單執行緒的加速比，以及與整段 sosfilt 的誤差"""
+    if file_path:
+        y, sr = load_audio(file_path)
+    else:
+        sr = 44100
+        y = (np.random.default_rng(0).standard_normal((2, int(seconds * sr))) * 0.1).astype(np.float32)
+    audio_seconds = y.shape[-1] / sr
+    print(f"{y.shape[0]} channels, {audio_seconds:.1f}s at {sr} Hz, {os.cpu_count()} cores, "
+          f"{EQ_CHUNK_SECONDS:.0f}s chunks with {EQ_WARMUP_SECONDS:.1f}s warm-up")
+
+    start = time.perf_counter()
+    reference = equalize(y, sr, gains)
+    single = time.perf_counter() - start
+    print(f"single pass    : {single * 1e3:8.1f} ms, {audio_seconds / single:6.0f}x realtime")
+
+    baseline = None
+    for count in workers:
+        best = min(timed(lambda: equalize_parallel(y, sr, gains, workers=count)) for _ in range(repeats))
+        baseline = baseline or best
+        out = equalize_parallel(y, sr, gains, workers=count)
+        speedup = baseline / best
+        print(f"{count:2d} threads     : {best * 1e3:8.1f} ms, {audio_seconds / best:6.0f}x realtime, "
+              f"speedup {speedup:4.2f}x ({speedup / count * 100:3.0f}% efficiency), "
+              f"max error vs single pass {np.abs(out - reference).max():.1e}")
+
+def benchmark_paint(frames=300):
+    """比較舊的 tostring 複製路徑與共用記憶體路徑每次繪製的耗時，以及整張重畫與 dirty rect 的差異"""
+    _ = QApplication.instance() or QApplication(sys.argv[:1])  # 建立 QWidget 前需要 QApplication，需保留參照
+    widget = PygameWidget()
+    screen = widget.screen
+    target = QImage(screen.get_width(), screen.get_height(), QImage.Format_ARGB32_Premultiplied)
+
+    def copy_paint():
+        painter = QPainter(target)
+        image = pygame.image.tostring(screen, 'RGBA')
+        qimage = QImage(image, screen.get_width(), screen.get_height(), QImage.Format_RGBA8888)
+        painter.drawImage(0, 0, qimage)
+        painter.end()
+
+    def shared_paint():
+        painter = QPainter(target)
+        painter.drawImage(0, 0, widget.qimage)
+        painter.end()
+
+    for name, paint in (('tostring copy', copy_paint), ('shared buffer', shared_paint)):
+        times = np.empty(frames)
+        tracemalloc.start()
+        for i in range(frames):
+            screen.fill((255, 255, 255) if i % 2 else (240, 240, 240))
+            start = time.perf_counter()
+            paint()
+            times[i] = time.perf_counter() - start
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print(f"{name:14s}: mean {times.mean() * 1e3:.3f} ms, p95 {np.percentile(times, 95) * 1e3:.3f} ms, "
+              f"peak Python allocation {peak / 2**20:.2f} MiB")
+
+    # 稀疏譜面每幀只有一個圓圈的範圍變動：整張清空重畫 vs 只清空並複製變動的矩形
+    for name, rect in (('full redraw', screen.get_rect()), ('dirty rect', pygame.Rect(359, 259, 82, 82))):
+        qrect = QRect(rect.x, rect.y, rect.width, rect.height)
+        times = np.empty(frames)
+        for i in range(frames):
+            start = time.perf_counter()
+            screen.set_clip(rect)
+            screen.fill((255, 255, 255) if i % 2 else (240, 240, 240))
+            screen.set_clip(None)
+            painter = QPainter(target)
+            painter.drawImage(qrect, widget.qimage, qrect)
+            painter.end()
+            times[i] = time.perf_counter() - start
+        print(f"{name:14s}: mean {times.mean() * 1e3:.3f} ms, p95 {np.percentile(times, 95) * 1e3:.3f} ms, "
+              f"{rect.width * rect.height} pixels/frame")
+
+def benchmark_notes(counts=(1000, 10000, 50000)):
+    """量測 NoteChart 的建立時間、每個圓圈的記憶體與每幀查詢耗時
+
+    模擬每 0.1 秒一個圓圈、出現後 0.1 秒被擊中，以 60 fps 跑完整首歌。
+    """
+    for count in counts:
+        beat_times = np.arange(count) * 0.1
+        start = time.perf_counter()
+        chart = NoteChart.from_beats(beat_times)
+        timeline = NoteTimeline(chart)
+        build = time.perf_counter() - start
+        frame_times = np.arange(0, count * 0.1, 1 / 60)
+        elapsed = np.empty(len(frame_times))
+        for frame, current_time in enumerate(frame_times):
+            start = time.perf_counter()
+            visible = timeline.advance(current_time)
+            elapsed[frame] = time.perf_counter() - start
+            for index in visible[chart.time[visible] <= current_time - 0.1].tolist():
+                timeline.hit(NoteChart.LETTERS[chart.letter[index]], current_time)
+        print(f"{count:6d} notes: build {build * 1e3:6.2f} ms ({build / count * 1e6:.2f} us/note), "
+              f"{chart.bytes_per_note()} bytes/note, advance {elapsed.mean() * 1e6:5.1f} us/frame "
+              f"(p99 {np.percentile(elapsed, 99) * 1e6:.1f} us)")
+
+def main_cli(argv):
+    parser = argparse.ArgumentParser(prog='LeonStreammediagameVer9B.py',
+                                     description='LeonBot Music Player command line tools')
+    commands = parser.add_subparsers(dest='command', required=True)
+    analyze = commands.add_parser('analyze', help='analyze a music folder without the GUI')
+    analyze.add_argument('folder')
+    analyze.add_argument('--out', default=CHART_DIR, help='directory for chart .npz files')
+    analyze.add_argument('--workers', type=int, default=None, help='number of worker processes (default: all cores)')
+    analyze.add_argument('--force', action='store_true', help='ignore cached beat maps')
+    analyze.add_argument('--ext', nargs='+', default=list(AUDIO_EXTENSIONS), help='audio file extensions to include')
+    analyze.add_argument('--wav', action='store_true', help='also write playback WAVs into the player cache')
+    render = commands.add_parser('render', help='write an equalized copy of a track')
+    render.add_argument('input')
+    render.add_argument('output', help='output .wav path')
+    render.add_argument('--gains', type=float, nargs=len(EQ_FREQUENCIES), required=True, metavar='DB',
+                        help='gain in dB for each band: ' + ' '.join(f'{freq}' for freq in EQ_FREQUENCIES) + ' Hz')
+    render.add_argument('--backend', choices=sorted(EQ_BACKENDS), default='iir',
+                        help='iir: peaking biquads in parallel chunks, fft: overlap-add with the combined response')
+    render.add_argument('--workers', type=int, default=None, help='number of threads for the iir backend (default: all cores)')
+    bench = commands.add_parser('bench', help='run micro benchmarks')
+    bench.add_argument('target', choices=['load', 'first-notes', 'progressive', 'paint', 'notes', 'eq', 'eq-render', 'eq-backends',
+                                          'stream'])
+    bench.add_argument('--file', help='audio file for the load, first-notes and stream benchmarks (optional for the eq benchmarks)')
+    bench.add_argument('--frames', type=int, default=300)
+    args = parser.parse_args(argv)
+    if args.command == 'bench':
+        if args.target == 'load':
+            if not args.file:
+                parser.error('bench load requires --file')
+            profile_load_audio(args.file, mono=True, target_sr=ANALYSIS_SR)
+        elif args.target == 'first-notes':
+            if not args.file:
+                parser.error('bench first-notes requires --file')
+            benchmark_first_notes(args.file)
+        elif args.target == 'progressive':
+            for silence in (0.0, 9.0, 12.0):
+                check_progressive_beats(silence)
+        elif args.target == 'stream':
+            if not args.file:
+                parser.error('bench stream requires --file')
+            benchmark_stream(args.file)
+        elif args.target == 'paint':
+            benchmark_paint(args.frames)
+        elif args.target == 'notes':
+            benchmark_notes()
+        elif args.target == 'eq':
+            benchmark_eq(args.file)
+        elif args.target == 'eq-render':
+            benchmark_eq_render(args.file)
+        elif args.target == 'eq-backends':
+            benchmark_eq_backends(args.file)
+        return 0
+    if args.command == 'analyze':
+        results = analyze_library(args.folder, args.out, args.workers, use_cache=not args.force,
+                                  extensions=tuple(ext.lower() for ext in args.ext), transcode=args.wav)
+        return 0 if results else 1
+    if args.command == 'render':
+        render_equalized(args.input, args.output, args.gains, args.workers, args.backend)
+        return 0
+    return 1
+
+# 預先畫好的圓圈與字母，所有 Circle 共用，key 為 (letter, radius, color)
+CIRCLE_COLOR = (255, 0, 0)
+circle_sprites = {}
+
+def circle_sprite(letter, radius, color=CIRCLE_COLOR):
+    sprite = circle_sprites.get((letter, radius, color))
+    if sprite is None:
+        center = radius + 1
+        sprite = pygame.Surface((center * 2, center * 2), pygame.SRCALPHA, 32, SCREEN_MASKS)
+        pygame.draw.circle(sprite, color, (center, center), radius, 2)
+        font = pygame.font.Font(None, 36)
+        text = font.render(letter, True, color)
+        sprite.blit(text, (center - radius // 2, center - radius // 2))
+        circle_sprites[(letter, radius, color)] = sprite
+    return sprite
+
+# 譜面：以 NumPy 陣列儲存所有圓圈（structure of arrays），每個圓圈是一個索引
+class NoteChart:
+    LETTERS = ('W', 'A', 'S', 'D')
+    FIELDS = (('time', np.float64), ('x', np.int16), ('y', np.int16), ('radius', np.int16),
+              ('letter', np.uint8), ('state', np.uint8))
+    # state 旗標
+    CLICKED = 1
+    MISSED = 2
+
+    def __init__(self, capacity=256, rng=None):
+        self.size = 0
+        self.rng = rng or np.random.default_rng()
+        for name, dtype in self.FIELDS:
+            setattr(self, name, np.empty(capacity, dtype=dtype))
+
+    @classmethod
+    def from_beats(cls, beat_times, radius=40, rng=None):
+        chart = cls(max(len(beat_times), 256), rng)
+        chart.extend_beats(beat_times, radius)
+        return chart
+
+    def __len__(self):
+        return self.size
+
+    def bytes_per_note(self):
+        return sum(np.dtype(dtype).itemsize for _, dtype in self.FIELDS)
+
+    def reserve(self, capacity):
+        # 容量不足時以倍數成長，漸進式加入圓圈時攤銷為 O(1)
+        if capacity <= len(self.time):
+            return
+        capacity = max(capacity, len(self.time) * 2)
+        for name, dtype in self.FIELDS:
+            grown = np.empty(capacity, dtype=dtype)
+            grown[:self.size] = getattr(self, name)[:self.size]
+            setattr(self, name, grown)
+
+    def extend_beats(self, beat_times, radius=40):
+        """以一批節奏點時間產生圓圈（位置與字母隨機），回傳新圓圈的索引範圍"""
+        beat_times = np.asarray(beat_times, dtype=np.float64)
+        start, stop = self.size, self.size + len(beat_times)
+        self.reserve(stop)
+        self.time[start:stop] = beat_times
+        self.x[start:stop] = self.rng.integers(50, 751, len(beat_times))
+        self.y[start:stop] = self.rng.integers(50, 551, len(beat_times))
+        self.radius[start:stop] = radius
+        self.letter[start:stop] = self.rng.integers(0, len(self.LETTERS), len(beat_times))
+        self.state[start:stop] = 0
+        self.size = stop
+        return start, stop
+
+    def unjudged(self, start, stop):
+        """[start, stop) 中尚未擊中或漏接的圓圈索引"""
+        return start + np.flatnonzero(self.state[start:stop] == 0)
+
+    def expire(self, start, stop, before):
+        """把 [start, stop) 中時間早於 before 且尚未判定的圓圈標為漏接，回傳其索引"""
+        expired = start + np.flatnonzero((self.state[start:stop] == 0) & (self.time[start:stop] < before))
+        self.state[expired] = self.MISSED
+        return expired
+
+    def draw(self, screen, indices):
+        screen.blits([(circle_sprite(self.LETTERS[letter], radius), (x - radius - 1, y - radius - 1))
+                      for x, y, radius, letter in zip(self.x[indices].tolist(), self.y[indices].tolist(),
+                                                      self.radius[indices].tolist(), self.letter[indices].tolist())],
+                     doreturn=False)
+
+    def bounds(self, indices):
+        """回傳圓圈在畫面上佔用的矩形（與 draw 貼上的 sprite 範圍相同）"""
+        return [pygame.Rect(x - radius - 1, y - radius - 1, radius * 2 + 2, radius * 2 + 2)
+                for x, y, radius in zip(self.x[indices].tolist(), self.y[indices].tolist(),
+                                        self.radius[indices].tolist())]
+
+# 判定範圍（秒）：按鍵與圓圈時間的差距在範圍內得到對應評價，超過 Good 即為 Miss
+JUDGMENT_WINDOWS = (('Perfect', 0.045), ('Great', 0.090), ('Good', 0.135))
+HIT_WINDOW = JUDGMENT_WINDOWS[-1][1]
+# 圓圈在節拍前多久出現（秒），讓玩家能在判定範圍內按下
+NOTE_APPROACH_TIME = 0.6
+
+def judge(offset):
+    for grade, window in JUDGMENT_WINDOWS:
+        if abs(offset) <= window:
+            return grade
+    return 'Miss'
+
+class NoteTimeline:
+    """以游標追蹤譜面中目前在畫面上的圓圈，並為每個字母保留依時間排序的待判定佇列"""
+    def __init__(self, chart):
+        self.chart = chart
+        self.cursor = 0      # 下一個尚未出現的圓圈
+        self.tail = 0        # 最早一個尚未判定的已出現圓圈
+        self.pending = [[] for _ in NoteChart.LETTERS]  # 每個字母的圓圈索引
+        self.heads = [0] * len(NoteChart.LETTERS)       # 每個字母佇列的開頭
+        self.indexed = 0
+        self.sync()
+
+    def sync(self):
+        # 把譜面中新加入的圓圈放進各字母的佇列
+        start, stop = self.indexed, len(self.chart)
+        letters = self.chart.letter[start:stop]
+        for code, queue in enumerate(self.pending):
+            queue.extend((start + np.flatnonzero(letters == code)).tolist())
+        self.indexed = stop
+
+    def extend(self, beat_times):
+        # 漸進式分析送來的節奏點都在既有圓圈之後，直接接在尾端即可
+        self.chart.extend_beats(beat_times)
+        self.sync()
+
+    def hit(self, letter, current_time, window=HIT_WINDOW):
+        """判定按下 letter 時最早的同字母圓圈，擊中時回傳 (索引, 時間差)，否則回傳 None"""
+        chart = self.chart
+        code = NoteChart.LETTERS.index(letter)
+        queue = self.pending[code]
+        head = self.heads[code]
+        # 略過已判定與已超過判定範圍的圓圈；後者留給 expire 標為漏接並計數
+        while head < len(queue):
+            index = queue[head]
+            if chart.state[index] == 0 and chart.time[index] >= current_time - window:
+                break
+            head += 1
+        hit = None
+        if head < len(queue) and chart.time[queue[head]] <= current_time + window:
+            index = queue[head]
+            chart.state[index] = NoteChart.CLICKED
+            hit = (index, float(current_time - chart.time[index]))
+            head += 1
+        self.heads[code] = head
+        return hit
+
+    def expire(self, current_time, window=HIT_WINDOW):
+        """把已超過判定範圍仍未擊中的圓圈標為漏接，回傳漏接的數量"""
+        chart = self.chart
+        stop = self.tail + int(np.searchsorted(chart.time[self.tail:len(chart)], current_time - window))
+        return len(chart.expire(self.tail, stop, current_time - window))
+
+    def advance(self, current_time):
+        """回傳已出現且尚未判定的圓圈索引，每幀只處理畫面上的範圍"""
+        chart = self.chart
+        self.cursor += int(np.searchsorted(chart.time[self.cursor:len(chart)], current_time, side='right'))
+        while self.tail < self.cursor and chart.state[self.tail] != 0:
+            self.tail += 1
+        return chart.unjudged(self.tail, self.cursor)
+
+class GameClock:
+    """以 pygame.mixer.music.get_pos() 為準的歌曲時間
+
+    get_pos() 只在混音器處理完一個緩衝區時才前進，兩次更新之間以 perf_counter 外插；
+    與音訊位置的偏差（drift）小時逐步修正，大於 snap_threshold 秒（例如卡頓）時直接對齊。
+    """
+    def __init__(self, smoothing=0.1, snap_threshold=0.1):
+        self.smoothing = smoothing
+        self.snap_threshold = snap_threshold
+        self.running = False
+        self.base_time = 0.0
+        self.base_counter = time.perf_counter()
+        self.last_time = 0.0
+        self.last_audio_pos = None
+        # drift 統計（秒）
+        self.drift = 0.0
+        self.max_drift = 0.0
+        self.drift_total = 0.0
+        self.drift_count = 0
+
+    def start(self):
+        self.running = True
+        self.base_time = 0.0
+        self.base_counter = time.perf_counter()
+        self.last_time = 0.0
+        self.last_audio_pos = None
+
+    def stop(self):
+        self.base_time = self.time()
+        self.running = False
+
+    def time(self):
+        if not self.running:
+            return self.base_time
+        # 修正時不讓歌曲時間倒退
+        self.last_time = max(self.last_time, self.base_time + time.perf_counter() - self.base_counter)
+        return self.last_time
+
+    def update(self):
+        if not self.running:
+            return
+        position = pygame.mixer.music.get_pos()
+        if position < 0 or position == self.last_audio_pos:
+            return
+        self.last_audio_pos = position
+        now = time.perf_counter()
+        predicted = self.base_time + now - self.base_counter
+        drift = position / 1000 - predicted
+        self.drift = drift
+        self.max_drift = max(self.max_drift, abs(drift))
+        self.drift_total += abs(drift)
+        self.drift_count += 1
+        correction = drift if abs(drift) > self.snap_threshold else drift * self.smoothing
+        self.base_time = predicted + correction
+        self.base_counter = now
+
+    def drift_stats(self):
+        """回傳 (最近一次, 平均絕對值, 最大絕對值) 的 drift，單位毫秒"""
+        mean = self.drift_total / self.drift_count if self.drift_count else 0.0
+        return self.drift * 1e3, mean * 1e3, self.max_drift * 1e3
+
+# 畫面每秒繪製次數、模擬（時鐘同步與漏接判定）每秒步進次數
+FRAME_RATE = 60
+SIM_RATE = 120
+# 落後太多時一次最多補幾個模擬步，避免越補越慢
+MAX_SIM_STEPS = 5
+
+class FrameStats:
+    """記錄每幀的間隔，計算 FPS、幀時間百分位數與掉幀數"""
+    def __init__(self, interval):
+        self.interval = interval
+        self.frame_times = []
+        self.dropped = 0
+
+    def record(self, frame_time):
+        self.frame_times.append(frame_time)
+        # 間隔超過 1.5 幀就代表中間有幀沒畫出來
+        if frame_time > 1.5 * self.interval:
+            self.dropped += int(round(frame_time / self.interval)) - 1
+
+    def summary(self, last=None):
+        """回傳 (FPS, p50, p95, p99)，幀時間單位毫秒；last 只統計最近幾幀"""
+        times = np.asarray(self.frame_times[-last:] if last else self.frame_times)
+        if not len(times):
+            return 0.0, 0.0, 0.0, 0.0
+        p50, p95, p99 = np.percentile(times, [50, 95, 99]) * 1e3
+        return 1.0 / times.mean(), p50, p95, p99
+
+class FrameScheduler(QObject):
+    """以 perf_counter 控制節奏的固定步長迴圈：tick 以固定步長模擬，render 以 frame_rate 繪製"""
+    def __init__(self, tick, render, sim_rate=SIM_RATE, frame_rate=FRAME_RATE, parent=None):
+        super().__init__(parent)
+        self.tick = tick
+        self.render = render
+        self.sim_step = 1.0 / sim_rate
+        self.frame_interval = 1.0 / frame_rate
+        self.stats = FrameStats(self.frame_interval)
+        self.timer = QTimer(self)
+        self.timer.setTimerType(Qt.PreciseTimer)
+        self.timer.setSingleShot(True)
+        self.timer.timeout.connect(self.step)
+
+    def start(self):
+        now = time.perf_counter()
+        self.sim_time = now
+        self.next_frame = now
+        self.last_frame = None
+        self.timer.start(0)
+
+    def stop(self):
+        self.timer.stop()
+
+    def step(self):
+        now = time.perf_counter()
+        steps = 0
+        while self.sim_time + self.sim_step <= now:
+            if steps == MAX_SIM_STEPS:
+                self.sim_time = now  # 放棄追趕，從現在重新開始
+                break
+            self.tick(self.sim_step)
+            self.sim_time += self.sim_step
+            steps += 1
+
+        if now >= self.next_frame:
+            self.render()
+            if self.last_frame is not None:
+                self.stats.record(now - self.last_frame)
+            self.last_frame = now
+            self.next_frame += self.frame_interval
+            if self.next_frame < now:
+                # 已經落後就對齊到現在，不補畫錯過的幀
+                self.next_frame = now + self.frame_interval
+
+        wake = min(self.next_frame, self.sim_time + self.sim_step)
+        # 無條件進位：提早醒來會以 0 ms 重新排程並空轉到截止時間
+        self.timer.start(max(0, math.ceil((wake - time.perf_counter()) * 1000)))
+
+# 延遲校正結果：audio_offset 為聽到節拍到按鍵的延遲，visual_offset 為看到閃爍到按鍵的延遲（毫秒）
+CALIBRATION_PATH = os.path.join(CACHE_ROOT, 'calibration.json')
+
+def load_calibration():
+    calibration = {'audio_offset_ms': 0.0, 'visual_offset_ms': 0.0}
+    try:
+        with open(CALIBRATION_PATH, 'r', encoding='utf-8') as f:
+            calibration.update(json.load(f))
+    except (OSError, ValueError):
+        pass
+    return calibration
+
+def save_calibration(calibration):
+    os.makedirs(CACHE_ROOT, exist_ok=True)
+    with open(CALIBRATION_PATH, 'w', encoding='utf-8') as f:
+        json.dump(calibration, f, indent=2)
+
+def tap_offsets(tap_times, beat_times, interval):
+    """每次按鍵相對最近一拍的偏移（秒），只保留半拍以內的按鍵"""
+    tap_times = np.asarray(tap_times, dtype=np.float64)
+    beat_times = np.asarray(beat_times, dtype=np.float64)
+    if len(tap_times) == 0 or len(beat_times) == 0:
+        return np.empty(0)
+    after = np.clip(np.searchsorted(beat_times, tap_times), 0, len(beat_times) - 1)
+    before = np.clip(after - 1, 0, len(beat_times) - 1)
+    nearest = np.where(np.abs(tap_times - beat_times[before]) < np.abs(tap_times - beat_times[after]), before, after)
+    offsets = tap_times - beat_times[nearest]
+    return offsets[np.abs(offsets) < interval / 2]
+
+def make_click_sound(frequency=1000, duration=0.03):
+    # 依混音器目前的格式產生節拍器的喀聲
+    sample_rate, _, channels = pygame.mixer.get_init()
+    t = np.arange(int(sample_rate * duration)) / sample_rate
+    wave_data = (np.sin(2 * np.pi * frequency * t) * np.exp(-t / (duration / 4)) * 0.8 * 32767).astype(np.int16)
+    if channels > 1:
+        wave_data = np.repeat(wave_data[:, None], channels, axis=1)
+    return pygame.sndarray.make_sound(np.ascontiguousarray(wave_data))
+
+class CalibrationDialog(QDialog):
+    """延遲校正：先聽節拍器按空白鍵，再看閃爍按空白鍵，以中位數作為音訊與畫面的延遲"""
+    INTERVAL_MS = 500
+    CLICKS = 20
+    WARMUP = 4  # 前幾拍讓使用者抓節奏，不列入計算
+
+    def __init__(self, parent=None):
+        super(CalibrationDialog, self).__init__(parent)
+        self.setWindowTitle('Latency Calibration')
+        self.setGeometry(500, 300, 400, 300)
+        layout = QVBoxLayout()
+        self.label = QLabel("Press Start, then tap SPACE on every click you hear.")
+        self.label.setWordWrap(True)
+        layout.addWidget(self.label)
+        self.flash = QFrame()
+        self.flash.setFixedHeight(120)
+        self.flash.setStyleSheet("background-color: #282828;")
+        layout.addWidget(self.flash)
+        self.start_button = QPushButton("Start")
+        self.start_button.clicked.connect(self.start_audio_phase)
+        layout.addWidget(self.start_button)
+        self.save_button = QPushButton("Save")
+        self.save_button.setEnabled(False)
+        self.save_button.clicked.connect(self.save)
+        layout.addWidget(self.save_button)
+        self.setLayout(layout)
+
+        self.timer = QTimer(self)
+        self.timer.setTimerType(Qt.PreciseTimer)
+        self.timer.timeout.connect(self.tick)
+        self.click_sound = None
+        self.phase = None
+        self.beat_times = []
+        self.tap_times = []
+        self.results = {}
+        self.calibration = load_calibration()
+
+    def start_audio_phase(self):
+        if self.click_sound is None:
+            self.click_sound = make_click_sound()
+        self.start_button.setEnabled(False)
+        self.start_phase('audio', "Tap SPACE on every click you hear.")
+
+    def start_phase(self, phase, message):
+        self.phase = phase
+        self.beat_times = []
+        self.tap_times = []
+        self.label.setText(message)
+        self.setFocus()
+        self.timer.start(self.INTERVAL_MS)
+
+    def tick(self):
+        if len(self.beat_times) >= self.CLICKS:
+            self.timer.stop()
+            self.finish_phase()
+            return
+        if self.phase == 'audio':
+            self.click_sound.play()
+        else:
+            self.flash.setStyleSheet("background-color: #FFFFFF;")
+            self.flash.repaint()
+            QTimer.singleShot(80, lambda: self.flash.setStyleSheet("background-color: #282828;"))
+        self.beat_times.append(time.perf_counter())
+
+    def keyPressEvent(self, event):
+        if event.key() == Qt.Key_Space and self.phase is not None:
+            self.tap_times.append(time.perf_counter())
+        else:
+            super().keyPressEvent(event)
+
+    def finish_phase(self):
+        offsets = tap_offsets(self.tap_times, self.beat_times[self.WARMUP:], self.INTERVAL_MS / 1000) * 1e3
+        self.results[self.phase] = offsets
+        if self.phase == 'audio':
+            self.start_phase('visual', "Now tap SPACE every time the box flashes.")
+            return
+        self.phase = None
+        lines = []
+        for phase in ('audio', 'visual'):
+            offsets = self.results[phase]
+            if len(offsets):
+                self.calibration[f'{phase}_offset_ms'] = float(np.median(offsets))
+                lines.append(f"{phase}: median {np.median(offsets):.1f} ms, mean {offsets.mean():.1f} ms, "
+                             f"std {offsets.std():.1f} ms ({len(offsets)} taps)")
+            else:
+                lines.append(f"{phase}: no usable taps")
+        self.label.setText("\n".join(lines))
+        self.save_button.setEnabled(True)
+        self.start_button.setText("Retry")
+        self.start_button.setEnabled(True)
+
+    def save(self):
+        save_calibration(self.calibration)
+        self.accept()
 
 class LoadingDialog(QDialog):
     def __init__(self, parent=None):
@@ -67,19 +1358,31 @@ class LoadingDialog(QDialog):
     def set_progress(self, value):
         self.progress_bar.setValue(value)
 
+# 與 QImage 的 32 位元 ARGB 格式相同的 Surface 色彩遮罩
+SCREEN_MASKS = (0x00FF0000, 0x0000FF00, 0x000000FF, 0xFF000000)
+
 class PygameWidget(QWidget):
     def __init__(self, parent=None):
         super(PygameWidget, self).__init__(parent)
         self.setFixedSize(800, 600)
-        self.screen = pygame.Surface((800, 600))
+        # Surface 的像素格式與 QImage.Format_ARGB32_Premultiplied 相同（畫面一律不透明），
+        # QImage 直接共用 Surface 的像素記憶體，每次繪製不需要複製或轉換
+        self.screen = pygame.Surface((800, 600), pygame.SRCALPHA, 32, SCREEN_MASKS)
+        self.screen.fill((255, 255, 255))
+        self.qimage = QImage(sip.voidptr(self.screen._pixels_address), self.screen.get_width(),
+                             self.screen.get_height(), self.screen.get_pitch(), QImage.Format_ARGB32_Premultiplied)
 
     def paintEvent(self, event):
+        # 只把需要重畫的範圍從 Surface 複製到視窗
         painter = QPainter(self)
-        image = pygame.image.tostring(self.screen, 'RGBA')
-        qimage = QImage(image, self.screen.get_width(), self.screen.get_height(), QImage.Format_RGBA8888)
-        painter.drawImage(0, 0, qimage)
+        painter.drawImage(event.rect(), self.qimage, event.rect())
+
+# 拖動等化器滑桿時，這段時間（毫秒）內的變動合併成一次重畫與一次增益更新
+EQ_UPDATE_INTERVAL_MS = 100
 
 class EqualizerWidget(QWidget):
+    gains_changed = pyqtSignal(list)
+
     def __init__(self):
         super().__init__()
         
@@ -89,13 +1392,13 @@ class EqualizerWidget(QWidget):
         self.sliders = []
         self.labels = []
         self.gains = [0] * 9
-        frequencies = [75, 150, 300, 600, 1200, 2400, 4800, 9600, 19200]
+        frequencies = list(EQ_FREQUENCIES)
         for i, freq in enumerate(frequencies):
             vbox = QVBoxLayout()
             slider = QSlider(Qt.Vertical)
             slider.setRange(-10, 10)
             slider.setValue(0)
-            slider.valueChanged.connect(self.update_gains)
+            slider.valueChanged.connect(self.schedule_update)
             label = QLabel(f'{freq} Hz')
             self.sliders.append(slider)
             self.labels.append(label)
@@ -110,27 +1413,127 @@ class EqualizerWidget(QWidget):
         self.main_layout.addWidget(self.canvas)
         
         self.setLayout(self.main_layout)
-        
+
+        # 座標軸只設定一次，之後只更新曲線的資料
+        self.line, = self.ax.plot(EQ_FREQUENCIES, self.gains, marker='o', color='purple')
+        self.ax.set_xscale('log')
+        self.ax.set_ylim(-10.5, 10.5)
+        self.ax.set_xlabel('Frequency (Hz)')
+        self.ax.set_ylabel('Gain (dB)')
+        self.ax.set_title('Equalizer')
+        self.ax.grid(True)
+
+        self.update_timer = QTimer(self)
+        self.update_timer.setSingleShot(True)
+        self.update_timer.timeout.connect(self.update_gains)
+
         self.update_plot()
+
+    def schedule_update(self):
+        # 計時器執行中就不重新計時，拖動時最多每 EQ_UPDATE_INTERVAL_MS 更新一次，並讀取當下最新的值
+        if not self.update_timer.isActive():
+            self.update_timer.start(EQ_UPDATE_INTERVAL_MS)
     
     def update_gains(self):
-        self.gains = [slider.value() for slider in self.sliders]
+        gains = [slider.value() for slider in self.sliders]
+        if gains == self.gains:
+            return
+        self.gains = gains
         self.update_plot()
+        self.gains_changed.emit(self.gains)
     
     def update_plot(self):
-        self.ax.clear()
-        
-        freqs = [75, 150, 300, 600, 1.2e3, 2.4e3, 4.8e3, 9.6e3, 19e3]
-        gains = self.gains
-        
-        self.ax.plot(freqs, gains, marker='o', color='purple')
-        self.ax.set_xscale('log')
-        self.ax.set_xlabel('Frequency (Hz)')
-        self.ax.set_ylabel('Gain (dB)')
-        self.ax.set_title('Equalizer')
-        self.ax.grid(True)
-        
-        self.canvas.draw()
+        self.line.set_ydata(self.gains)
+        self.canvas.draw_idle()
+
+class EqualizerStream(QObject):
+    """聆聽模式的播放：從快取的 WAV 逐塊讀出 EQ_BLOCK 個取樣，等化後排進 pygame 聲道
+
+    sosfilt 的狀態在區塊之間延續，調整增益只換係數，下一個區塊就會套用，
+    不必重寫檔案也不會回到開頭。WAV 須已是混音器的取樣率（transcode_to_wav 寫出的檔案）。
+    """
+    finished = pyqtSignal()
+
+    def __init__(self, wav_path, gains, parent=None):
+        super().__init__(parent)
+        self.sr, _, self.channels = pygame.mixer.get_init()
+        self.wav_file = wave.open(wav_path, 'rb')
+        if self.wav_file.getframerate() != self.sr or self.wav_file.getsampwidth() != 2:
+            self.wav_file.close()
+            raise ValueError(f"{wav_path} 不是 {self.sr} Hz 16-bit 的 WAV，請先以 transcode_to_wav 轉檔")
+        self.source_channels = self.wav_file.getnchannels()
+        self.total_frames = self.wav_file.getnframes()
+        self.duration = self.total_frames / self.sr
+        self.set_gains(gains)
+        self.zi = np.zeros((len(self.sos), self.channels, 2))
+        self.position = 0        # 下一個要等化的取樣
+        self.playing_start = 0   # 正在播放的區塊從第幾個取樣開始
+        self.queued_start = None # 排隊中的區塊從第幾個取樣開始
+        self.underruns = 0       # 兩個區塊都播完才補上的次數
+        self.channel = pygame.mixer.Channel(0)
+        self.timer = QTimer(self)
+        self.timer.setTimerType(Qt.PreciseTimer)
+        self.timer.timeout.connect(self.feed)
+
+    def set_gains(self, gains):
+        self.sos = peaking_eq_sos(self.sr, tuple(float(gain) for gain in gains), flat_bands=True)
+
+    def next_block(self):
+        frames = np.frombuffer(self.wav_file.readframes(EQ_BLOCK), dtype='<i2').reshape(-1, self.source_channels)
+        if self.source_channels != self.channels:
+            frames = frames.mean(axis=1, keepdims=True).repeat(self.channels, axis=1)
+        block = frames.T.astype(np.float32) / 32768
+        self.position += block.shape[1]
+        if len(self.sos):
+            block, self.zi = sosfilt(self.sos, block, axis=-1, zi=self.zi)
+        block = np.clip(block.T * 32768, -32768, 32767).astype(np.int16)
+        return pygame.mixer.Sound(buffer=block.tobytes())
+
+    def play(self, start=0.0):
+        self.seek(start)
+        self.timer.start(5)
+
+    def seek(self, seconds):
+        self.channel.stop()
+        self.position = min(int(seconds * self.sr), self.total_frames)
+        self.wav_file.setpos(self.position)
+        self.zi[:] = 0
+        self.queued_start = None
+        self.feed()
+
+    def feed(self):
+        # 聲道只能排一個區塊，前一個開始播放後就補上下一個
+        if self.position >= self.total_frames:
+            if not self.channel.get_busy():
+                self.timer.stop()
+                self.finished.emit()
+            return
+        if not self.channel.get_busy():
+            if self.queued_start is not None:
+                self.underruns += 1
+            self.playing_start = self.position
+            self.queued_start = None
+            self.channel.play(self.next_block())
+        if self.channel.get_queue() is None and self.position < self.total_frames:
+            if self.queued_start is not None:
+                self.playing_start = self.queued_start  # 排隊的區塊已經開始播放
+            self.queued_start = self.position
+            self.channel.queue(self.next_block())
+
+    def pause(self):
+        self.channel.pause()
+
+    def unpause(self):
+        self.channel.unpause()
+
+    def stop(self):
+        self.timer.stop()
+        self.channel.stop()
+        self.wav_file.close()
+
+    def tell(self):
+        """目前播放位置（秒），精確度為一個區塊"""
+        return self.playing_start / self.sr
 
 class MusicGameApp(QWidget):
     def __init__(self):
@@ -176,6 +1579,21 @@ class MusicGameApp(QWidget):
         self.track_list_widget.itemClicked.connect(self.on_item_clicked)  # 連接列表項點擊事件
         self.left_layout.addWidget(self.track_list_widget)
 
+        # 遊戲模式的曲目載入排程，只保留最新的載入工作
+        self.loading_dialog = None
+        self.load_scheduler = LoadScheduler(self)
+        self.load_scheduler.progress.connect(self.set_loading_progress)
+        self.load_scheduler.ready.connect(self.on_loading_ready)
+        self.load_scheduler.beats.connect(self.on_beats_ready)
+        self.load_scheduler.finished.connect(self.on_loading_finished)
+        self.load_scheduler.failed.connect(self.on_loading_failed)
+
+        # 背景預先分析音樂庫
+        self.library_indexer = None
+        if BACKGROUND_INDEXING:
+            self.library_indexer = LibraryIndexer(self.track_list)
+            self.library_indexer.start()
+
         # 播放控制按鈕
         control_layout = QHBoxLayout()
 
@@ -224,6 +1642,12 @@ class MusicGameApp(QWidget):
         self.switch_mode_button.clicked.connect(self.switch_mode)
         self.left_layout.addWidget(self.switch_mode_button)
 
+        # 延遲校正按鈕
+        self.calibrate_button = QPushButton("Calibrate Latency")
+        self.calibrate_button.setStyleSheet("background-color: #1DB954; border: none;")
+        self.calibrate_button.clicked.connect(self.open_calibration)
+        self.left_layout.addWidget(self.calibrate_button)
+
         self.left_frame.setLayout(self.left_layout)
         self.main_layout.addWidget(self.left_frame)
 
@@ -246,8 +1670,10 @@ class MusicGameApp(QWidget):
         self.max_combo_label = QLabel('Max Combo: 0', self)
         self.max_combo_label.setStyleSheet('font-size: 18px; color: white;')
 
-        # 增加等化器
+        # 增加等化器，聆聽模式的播放經過 EqualizerStream 即時套用
         self.equalizer = EqualizerWidget()
+        self.equalizer.gains_changed.connect(self.update_equalizer)
+        self.stream = None
 
         # 设置右侧布局
         self.right_layout = QVBoxLayout()
@@ -285,8 +1711,9 @@ class MusicGameApp(QWidget):
         self.progress_slider.sliderPressed.connect(self.slider_pressed)
         self.progress_slider.sliderReleased.connect(self.slider_released)
 
-        # 初始化播放
-        pygame.mixer.init()
+        # 初始化播放，保留聲道 0 給 EqualizerStream
+        pygame.mixer.init(frequency=PLAYBACK_SR)
+        pygame.mixer.set_reserved(1)
 
         # 創建計時器以定期更新進度條和時間標籤
         self.progress_timer = QTimer(self)
@@ -319,60 +1746,69 @@ class MusicGameApp(QWidget):
 
     def convert_to_wav(self, track_path):
         """將 MP3 文件轉換為 WAV 文件"""
-        unique_suffix = f"_{random.randint(1000, 9999)}"
-        wav_path = track_path.replace('.mp3', unique_suffix + '.wav')
-        if os.path.exists(wav_path):
-            os.remove(wav_path)
-            time.sleep(0.1)  # 添加短暫等待時間，確保文件資源已被釋放
-        audio = AudioSegment.from_file(track_path)
-        audio.export(wav_path, format='wav')
-        return wav_path
+        return transcode_to_wav(track_path)
 
     def play_pause_music(self):
+        if self.stream is None:
+            return
         if self.is_playing:
-            pygame.mixer.music.pause()
+            self.stream.pause()
             self.play_button.setIcon(self.style().standardIcon(QStyle.SP_MediaPlay))
         else:
-            pygame.mixer.music.unpause()
+            self.stream.unpause()
             self.play_button.setIcon(self.style().standardIcon(QStyle.SP_MediaPause))
         self.is_playing = not self.is_playing
 
     def play_music(self):
         track_path = self.track_list[self.current_track_index]
         if self.mode == 'gaming':
-            self.loading_dialog = LoadingDialog(self)
-            self.loading_dialog.show()
-
-            self.loading_thread = QThread()
-            self.loading_worker = LoadingWorker(track_path)
-            self.loading_worker.moveToThread(self.loading_thread)
-            self.loading_worker.progress.connect(self.loading_dialog.set_progress)
-            self.loading_worker.finished.connect(self.on_loading_finished)
-            self.loading_thread.started.connect(self.loading_worker.process)
-            self.loading_worker.finished.connect(self.loading_thread.quit)  # Ensure thread quits properly
-            self.loading_worker.finished.connect(self.loading_worker.deleteLater)
-            self.loading_thread.finished.connect(self.loading_thread.deleteLater)
-            self.loading_thread.start()
+            self.start_loading(track_path)
         else:
             wav_path = self.convert_to_wav(track_path)
-            pygame.mixer.music.load(wav_path)
-            pygame.mixer.music.play()
-            self.set_track_duration(wav_path)  # 設置進度條的最大值
+            self.stop_music()
+            self.stream = EqualizerStream(wav_path, self.equalizer.gains, self)
+            self.stream.finished.connect(self.on_music_end)
+            self.stream.play()
+            self.set_track_duration(self.stream.duration)  # 設置進度條的最大值
             self.play_button.setIcon(self.style().standardIcon(QStyle.SP_MediaPause))
             self.is_playing = True
 
-    def set_track_duration(self, wav_path):
-        # 使用 pygame.mixer.Sound 來獲取音樂文件的長度
-        sound = pygame.mixer.Sound(wav_path)
-        duration = sound.get_length()
+    def start_loading(self, track_path):
+        # 新的載入會取代尚未完成的舊載入，共用同一個載入對話框
+        self.pause_indexer()
+        if self.loading_dialog is None:
+            self.loading_dialog = LoadingDialog(self)
+            self.loading_dialog.rejected.connect(self.cancel_loading)
+        self.loading_dialog.set_progress(0)
+        self.loading_dialog.show()
+        self.load_scheduler.submit(track_path)
+
+    def cancel_loading(self):
+        # 關閉載入對話框或切回聆聽模式時放棄載入，之後也不會再開啟遊戲視窗
+        self.load_scheduler.cancel()
+        if self.loading_dialog is not None and self.loading_dialog.isVisible():
+            self.loading_dialog.hide()
+        self.resume_indexer()
+
+    def set_loading_progress(self, value):
+        if self.loading_dialog is not None:
+            self.loading_dialog.set_progress(value)
+
+    def on_loading_failed(self, message):
+        print(f"Loading failed: {message}")
+        if self.loading_dialog is not None:
+            self.loading_dialog.accept()
+        self.resume_indexer()
+
+    def set_track_duration(self, duration):
         self.progress_slider.setMaximum(int(duration))
         self.progress_slider.setValue(0)
         self.update_time_label(0)
         self.remaining_time_bar.setMaximum(int(duration))
 
     def update_progress(self):
-        if self.is_playing:
-            position = pygame.mixer.music.get_pos() // 1000
+        if self.is_playing and self.stream is not None:
+            position = int(self.stream.tell())
             self.progress_slider.setValue(position)
             self.update_time_label(position)
             total_length = self.progress_slider.maximum()
@@ -384,68 +1820,79 @@ class MusicGameApp(QWidget):
             self.remaining_time_label.setText(f'Remaining Time: {remaining_time.toString("mm:ss")}')
             self.remaining_time_bar.setValue(position)
 
-    def on_loading_finished(self, data):
-        y, sr, tempo, beats, wav_path = data
-        self.y = y
-        self.sr = sr
-        self.filtered_y = y  # 初始化为原始音频数据
-        self.beat_times = beats[::5]
-
+    def on_loading_ready(self, data):
+        # 開頭的節奏點分析完就開始遊戲，其餘的由 on_beats_ready 陸續補上
+        tempo, beats, wav_path = data
         print(f"Tempo: {tempo}")
-        print(f"Selected beat times: {self.beat_times}")
-
-        self.circles = []
-        letters = ['W', 'A', 'S', 'D']
-        for beat_time in self.beat_times:
-            self.generate_circle(beat_time, random.choice(letters))
 
-        for circle in self.circles:
-            print(f"Circle: {circle.x}, {circle.y}, {circle.radius}, {circle.time_to_show}, {circle.letter}")
+        self.beat_count = 0
+        self.chart = NoteChart.from_beats(self.select_chart_beats(beats))
+        self.circle_count_label.setText(f'Circles: {len(self.chart)}')
 
-        self.loading_dialog.close()
-        self.open_game_window(wav_path, self.circles)
+        if self.loading_dialog is not None:
+            self.loading_dialog.accept()
+        self.open_game_window(wav_path, self.chart)
 
-    def generate_circle(self, time_to_show, letter):
-        x = random.randint(50, 750)
-        y = random.randint(50, 550)
-        radius = 40
-        circle = Circle(x, y, radius, time_to_show, letter)
-        self.circles.append(circle)
-        self.circle_count_label.setText(f'Circles: {len(self.circles)}')
+    def on_beats_ready(self, beats):
+        if getattr(self, 'game_window', None) is not None:
+            self.game_window.add_notes(self.select_chart_beats(beats))
+            self.circle_count_label.setText(f'Circles: {len(self.chart)}')
 
-    def open_game_window(self, wav_path, circles):
-        self.game_window = GameWindow(wav_path, circles, self.combo, self.max_combo)
+    def on_loading_finished(self, data):
+        tempo, beats, wav_path = data
+        self.beat_times = beats[::CHART_BEAT_STRIDE]
+
+    def select_chart_beats(self, beats):
+        # 依全曲的節奏點序號每隔 CHART_BEAT_STRIDE 個取一個作為圓圈
+        beats = np.asarray(beats)
+        indices = np.arange(self.beat_count, self.beat_count + len(beats))
+        self.beat_count += len(beats)
+        selected = beats[indices % CHART_BEAT_STRIDE == 0]
+        print(f"Selected beat times: {selected}")
+        return selected
+
+    def open_game_window(self, wav_path, chart):
+        # 只保留最新載入曲目的遊戲視窗；被取代的視窗不恢復背景分析，新遊戲開始時仍維持暫停
+        if getattr(self, 'game_window', None) is not None:
+            self.game_window.closed.disconnect(self.resume_indexer)
+            self.game_window.close()
+        self.game_window = GameWindow(wav_path, chart, self.combo, self.max_combo)
+        self.game_window.closed.connect(self.resume_indexer)
         self.game_window.show()
 
+    def pause_indexer(self):
+        # 載入與遊戲進行時暫停背景分析
+        if self.library_indexer is not None:
+            self.library_indexer.pause()
+
+    def resume_indexer(self):
+        # 還有遊戲在進行（例如只是新的載入失敗）時維持暫停
+        game_window = getattr(self, 'game_window', None)
+        if game_window is not None and game_window.running:
+            return
+        if self.library_indexer is not None:
+            self.library_indexer.resume()
+
     def update_time_label(self, current_position):
         remaining_seconds = self.progress_slider.maximum() - current_position
         remaining_time = QTime(0, (remaining_seconds // 60) % 60, int(remaining_seconds % 60))
         self.time_label.setText(f'Remaining Time: {remaining_time.toString("mm:ss")}')
     
-    def apply_equalizer(self, y, freqs, gains, sr):
-        for freq, gain in zip(freqs, gains):
-            if gain != 0:
-                low = freq / np.sqrt(2)
-                high = freq * np.sqrt(2)
-                b, a = butter(2, [low / (0.5 * sr), high / (0.5 * sr)], btype='band')
-                y = lfilter(b, a, y) * (10 ** (gain / 20))
-        return y
-
-    def update_equalizer(self):
-        freqs = [75, 150, 300, 600, 1.2e3, 2.4e3, 4.8e3, 9.6e3, 19e3]
-        gains = self.equalizer.gains
-        self.filtered_y = self.apply_equalizer(self.y, freqs, gains, self.sr)
-        temp_wav_path = "temp_filtered.wav"
-        librosa.output.write_wav(temp_wav_path, self.filtered_y, self.sr)
-        pygame.mixer.music.load(temp_wav_path)
-        pygame.mixer.music.play()
+    def update_equalizer(self, gains):
+        # 只更換係數，播放中的串流從下一個區塊開始套用
+        if self.stream is not None:
+            self.stream.set_gains(gains)
 
     def slider_pressed(self):
-        pygame.mixer.music.pause()
+        if self.stream is not None:
+            self.stream.pause()
 
     def slider_released(self):
+        if self.stream is None:
+            return
         seek_seconds = self.progress_slider.value()
-        pygame.mixer.music.play(start=seek_seconds)
+        self.stream.seek(seek_seconds)
+        self.stream.unpause()
         self.is_playing = True
 
     def switch_mode(self):
@@ -453,28 +1900,24 @@ class MusicGameApp(QWidget):
         if self.mode == 'listening':
             self.mode = 'gaming'
             self.switch_mode_button.setText('Switch to Listening Mode')
-            self.loading_dialog = LoadingDialog(self)
-            self.loading_dialog.show()
-            
-            self.loading_thread = QThread()
-            self.loading_worker = LoadingWorker(self.track_list[self.current_track_index])
-            self.loading_worker.moveToThread(self.loading_thread)
-            self.loading_worker.progress.connect(self.loading_dialog.set_progress)
-            self.loading_worker.finished.connect(self.on_loading_finished)
-            self.loading_thread.started.connect(self.loading_worker.process)
-            self.loading_worker.finished.connect(self.loading_thread.quit)  # Ensure thread quits properly
-            self.loading_worker.finished.connect(self.loading_worker.deleteLater)
-            self.loading_thread.finished.connect(self.loading_thread.deleteLater)
-            self.loading_thread.start()
+            self.start_loading(self.track_list[self.current_track_index])
         else:
             self.mode = 'listening'
             self.switch_mode_button.setText('Switch to Gaming Mode')
+            self.cancel_loading()
             self.play_music()
 
     def stop_music(self):
         pygame.mixer.music.stop()
+        if self.stream is not None:
+            self.stream.stop()
+            self.stream = None
         self.is_playing = False
 
+    def open_calibration(self):
+        self.stop_music()
+        CalibrationDialog(self).exec_()
+
     def toggle_random_play(self):
         self.random_play = not self.random_play
         if self.random_play:
@@ -485,57 +1928,250 @@ class MusicGameApp(QWidget):
     def check_music_end(self):
         for event in pygame.event.get():
             if event.type == pygame.USEREVENT + 1:
-                if self.random_play:
-                    self.current_track_index = random.randint(0, len(self.track_list) - 1)
-                    self.play_music()
-                else:
-                    self.next_track()
+                self.on_music_end()
+
+    def on_music_end(self):
+        if self.random_play:
+            self.current_track_index = random.randint(0, len(self.track_list) - 1)
+            self.play_music()
+        else:
+            self.next_track()
 
     def closeEvent(self, event):
         total_use_time = time.time() - self.start_time
         print(f"Total use time: {total_use_time // 60} minutes {int(total_use_time % 60)} seconds")
+        self.load_scheduler.cancel()
+        self.stop_music()
+        if self.library_indexer is not None:
+            self.library_indexer.stop()
         super().closeEvent(event)
 
-class LoadingWorker(QObject):
-    finished = pyqtSignal(object)
-    progress = pyqtSignal(int)
+class LoadingSignals(QObject):
+    ready = pyqtSignal(int, object)
+    beats = pyqtSignal(int, object)
+    finished = pyqtSignal(int, object)
+    progress = pyqtSignal(int, int)
+    failed = pyqtSignal(int, str)
 
-    def __init__(self, track_path):
+class LoadingWorker(QRunnable):
+    def __init__(self, track_path, job_id=0, cancel=None):
         super().__init__()
         self.track_path = track_path
+        self.job_id = job_id
+        self.cancel = cancel or CancelToken()
+        self.signals = LoadingSignals()
+        self.ready_sent = False
+
+    def run(self):
+        self.process()
 
     def process(self):
-        y, sr = load_audio(self.track_path)
-        tempo, beats = librosa.beat.beat_track(y=y, sr=sr, units='time')
-        unique_suffix = f"_{random.randint(1000, 9999)}"
-        wav_path = self.track_path.replace('.mp3', unique_suffix + '.wav')
         try:
-            if os.path.exists(wav_path):
-                os.remove(wav_path)
-            audio = AudioSegment.from_file(self.track_path)
-            audio.export(wav_path, format='wav')
-        except PermissionError:
-            print(f"Permission denied: '{wav_path}'")
-        self.progress.emit(100)
-        self.finished.emit((y, sr, tempo, beats, wav_path))
+            result = analyze_track(self.track_path, progress=self.emit_progress, cancel=self.cancel,
+                                   on_beats=self.emit_beats)
+        except LoadCancelled:
+            print(f"Loading cancelled: {os.path.basename(self.track_path)}")
+            return
+        except Exception as error:
+            self.signals.failed.emit(self.job_id, str(error))
+            return
+        print(f"Loaded {os.path.basename(self.track_path)}{' (cached)' if result['cached'] else ''}: "
+              f"decode {result['decode_s']:.2f}s, analysis {result['analysis_s']:.2f}s, "
+              f"transcode {result['transcode_s']:.2f}s, total {result['total_s']:.2f}s")
+        self.signals.finished.emit(self.job_id, (result['tempo'], result['beats'], result['wav_path']))
+
+    def emit_progress(self, value):
+        self.signals.progress.emit(self.job_id, value)
+
+    def emit_beats(self, tempo, beats, wav_path):
+        # 第一段節奏點送出 ready 讓遊戲開始，之後的只送出新增的節奏點
+        if not self.ready_sent:
+            self.ready_sent = True
+            self.signals.ready.emit(self.job_id, (tempo, beats, wav_path))
+        else:
+            self.signals.beats.emit(self.job_id, beats)
+
+class LoadScheduler(QObject):
+    """在有限的執行緒池中載入曲目，新的請求會取消舊的（最新者優先）"""
+    ready = pyqtSignal(object)
+    beats = pyqtSignal(object)
+    finished = pyqtSignal(object)
+    progress = pyqtSignal(int)
+    failed = pyqtSignal(str)
+
+    def __init__(self, parent=None, max_threads=2):
+        super().__init__(parent)
+        self.pool = QThreadPool(self)
+        self.pool.setMaxThreadCount(max_threads)
+        self.job_id = 0
+        self.worker = None
+        # 啟動時就在背景完成首次分析的編譯成本，第一首曲目的預覽不必等待
+        threading.Thread(target=warm_up_analysis, daemon=True).start()
+
+    def submit(self, track_path):
+        self.cancel()
+        self.job_id += 1
+        self.worker = LoadingWorker(track_path, self.job_id)
+        self.worker.signals.progress.connect(self.on_progress)
+        self.worker.signals.ready.connect(self.on_ready)
+        self.worker.signals.beats.connect(self.on_beats)
+        self.worker.signals.finished.connect(self.on_finished)
+        self.worker.signals.failed.connect(self.on_failed)
+        self.pool.start(self.worker)
+
+    def cancel(self):
+        if self.worker is not None:
+            self.worker.cancel.cancel()
+            self.worker = None
+            self.job_id += 1  # 已經送出但還沒處理的訊號也一併丟棄
+
+    # 只轉發目前這個工作的訊號，被取代的工作結果直接丟棄
+    def on_progress(self, job_id, value):
+        if job_id == self.job_id:
+            self.progress.emit(value)
+
+    def on_ready(self, job_id, data):
+        if job_id == self.job_id:
+            self.ready.emit(data)
+
+    def on_beats(self, job_id, beats):
+        if job_id == self.job_id:
+            self.beats.emit(beats)
+
+    def on_finished(self, job_id, data):
+        if job_id == self.job_id:
+            self.worker = None
+            self.finished.emit(data)
+
+    def on_failed(self, job_id, message):
+        if job_id == self.job_id:
+            self.worker = None
+            self.failed.emit(message)
+
+# 背景預先分析音樂庫為選用功能，設定環境變數 LEONSTREAM_PREINDEX=1 開啟
+BACKGROUND_INDEXING = os.environ.get('LEONSTREAM_PREINDEX') == '1'
+
+def lower_process_priority():
+    # 背景分析的子行程使用最低優先權，不與遊戲搶 CPU
+    if hasattr(os, 'nice'):
+        os.nice(19)
+    elif sys.platform == 'win32':
+        import ctypes
+        IDLE_PRIORITY_CLASS = 0x40
+        ctypes.windll.kernel32.SetPriorityClass(ctypes.windll.kernel32.GetCurrentProcess(), IDLE_PRIORITY_CLASS)
+
+class LibraryIndexer(QObject):
+    """在背景行程池中預先分析整個音樂庫，遊戲進行時可暫停"""
+    track_indexed = pyqtSignal(str)
+
+    def __init__(self, track_list, max_workers=None):
+        super().__init__()
+        self.track_list = list(track_list)
+        self.max_workers = max_workers or max(1, min(4, (os.cpu_count() or 2) - 1))
+        self.executor = None
+        self.feeder = None
+        self.running = threading.Event()
+        self.running.set()
+        self.stopped = threading.Event()
+        # 限制同時送進行程池的工作數，暫停時不會有大量排隊中的工作
+        self.slots = threading.Semaphore(self.max_workers)
+
+    def start(self):
+        self.executor = ProcessPoolExecutor(max_workers=self.max_workers, initializer=lower_process_priority)
+        self.feeder = threading.Thread(target=self.feed, daemon=True)
+        self.feeder.start()
+
+    def pause(self):
+        self.running.clear()
+
+    def resume(self):
+        self.running.set()
+
+    def stop(self):
+        self.stopped.set()
+        self.running.set()
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+
+    def feed(self):
+        for track_path in self.track_list:
+            try:
+                # 只檢查是否存在，不更新修改時間，以免打亂 evict_lru 的使用順序
+                if load_beat_map(track_path) is not None and os.path.exists(wav_cache_path(track_path)):
+                    continue
+            except OSError:
+                continue
+            while True:
+                self.running.wait()
+                self.slots.acquire()
+                # 等待空位期間可能已被暫停，放回空位後重新等待恢復
+                if self.running.is_set() or self.stopped.is_set():
+                    break
+                self.slots.release()
+            if self.stopped.is_set():
+                return
+            try:
+                future = self.executor.submit(analyze_track, track_path)
+            except RuntimeError:
+                # 行程池已關閉
+                return
+            future.add_done_callback(self.on_done)
+
+    def on_done(self, future):
+        self.slots.release()
+        if future.cancelled():
+            return
+        error = future.exception()
+        if error is not None:
+            print(f"Background analysis failed: {error}")
+            return
+        self.track_indexed.emit(future.result()['track'])
+
+SESSION_DIR = os.path.join(CACHE_ROOT, 'sessions')
+judgment_texts = {}
+
+def judgment_text(grade):
+    if grade not in judgment_texts:
+        font = pygame.font.Font(None, 48)
+        judgment_texts[grade] = font.render(grade, True, (0, 0, 0))
+    return judgment_texts[grade]
 
 class GameWindow(QMainWindow):
-    def __init__(self, wav_path, circles, combo, max_combo):
+    closed = pyqtSignal()
+
+    def __init__(self, wav_path, chart, combo, max_combo):
         super().__init__()
         self.setWindowTitle('Game Mode')
         self.setGeometry(100, 100, 800, 600)
 
         self.wav_path = wav_path
-        self.circles = circles
+        self.chart = chart
+        self.timeline = NoteTimeline(chart)
+        self.clock = GameClock()
+        # 判定時間扣掉聽到節拍到按鍵的延遲；圓圈提早或延後出現，讓畫面與聲音同時到達
+        calibration = load_calibration()
+        self.audio_offset = calibration['audio_offset_ms'] / 1000
+        self.visual_offset = calibration['visual_offset_ms'] / 1000
         self.combo = combo
         self.max_combo = max_combo
+        # 本局的判定統計與每次擊中的時間差（毫秒）
+        self.judgments = {grade: 0 for grade, _ in JUDGMENT_WINDOWS}
+        self.judgments['Miss'] = 0
+        self.hit_offsets = []
+        self.last_judgment = None
 
         self.pygame_widget = PygameWidget(self)
         self.setCentralWidget(self.pygame_widget)
 
-        self.timer = QTimer(self)
-        self.timer.timeout.connect(self.update_pygame)
-        self.timer.start(16)  # 每16毫秒更新一次Pygame顯示
+        # 模擬與繪製分開排程，F3 切換畫面上的幀數統計
+        self.scheduler = FrameScheduler(self.simulate, self.update_pygame, parent=self)
+        self.show_stats = False
+        self.stats_text = None
+        self.stats_refreshed = 0.0
+        # 上一幀畫出的圓圈與文字，用來找出這一幀需要重畫的範圍
+        self.drawn = set()
+        self.drawn_overlays = []
+        self.full_redraw = True
 
         self.start_game()
 
@@ -543,38 +2179,142 @@ class GameWindow(QMainWindow):
         self.running = True
         pygame.mixer.music.load(self.wav_path)
         pygame.mixer.music.play()
-        self.start_time = time.time()
+        self.clock.start()
+        self.scheduler.start()
+
+    def add_notes(self, beat_times):
+        self.timeline.extend(beat_times)
 
     def keyPressEvent(self, event):
         if event.key() in [Qt.Key_W, Qt.Key_A, Qt.Key_S, Qt.Key_D]:
             key_letter = chr(event.key())
             self.check_circle_click(key_letter)
+        elif event.key() == Qt.Key_F3:
+            self.show_stats = not self.show_stats
+            self.stats_text = None
 
     def check_circle_click(self, letter):
-        hit_circle = False
-        for circle in self.circles:
-            if not circle.clicked and circle.letter == letter:
-                circle.click()
-                hit_circle = True
-                self.combo += 1
-                if self.combo > self.max_combo:
-                    self.max_combo = self.combo
-                break
-        if not hit_circle:
+        current_time = self.clock.time() - self.audio_offset
+        hit = self.timeline.hit(letter, current_time)
+        if hit is not None:
+            _, offset = hit
+            grade = judge(offset)
+            self.judgments[grade] += 1
+            self.hit_offsets.append(offset * 1e3)
+            self.last_judgment = grade
+            self.combo += 1
+            if self.combo > self.max_combo:
+                self.max_combo = self.combo
+        else:
             self.combo = 0
 
-    def update_pygame(self):
+    def expire_notes(self):
+        # 超過判定範圍仍未擊中的圓圈自動判為 Miss
+        missed = self.timeline.expire(self.clock.time() - self.audio_offset)
+        if missed:
+            self.judgments['Miss'] += missed
+            self.last_judgment = 'Miss'
+            self.combo = 0
+
+    def export_session(self):
+        """把本局每次擊中的時間差與判定統計存成 .npz 供分析，回傳檔案路徑"""
+        offsets = np.asarray(self.hit_offsets, dtype=np.float32)
+        if len(offsets):
+            print(f"Hit offsets: mean {offsets.mean():.1f} ms, std {offsets.std():.1f} ms, "
+                  f"p50 |offset| {np.percentile(np.abs(offsets), 50):.1f} ms, "
+                  f"p95 |offset| {np.percentile(np.abs(offsets), 95):.1f} ms")
+        print(f"Judgments: {self.judgments}")
+        os.makedirs(SESSION_DIR, exist_ok=True)
+        path = os.path.join(SESSION_DIR, time.strftime('session_%Y%m%d_%H%M%S.npz'))
+        stats = self.scheduler.stats
+        fps, p50, p95, p99 = stats.summary()
+        print(f"Frames: {fps:.1f} fps, p50 {p50:.1f} ms, p95 {p95:.1f} ms, p99 {p99:.1f} ms, "
+              f"dropped {stats.dropped}")
+        np.savez(path, hit_offsets_ms=offsets, grades=np.array(list(self.judgments)),
+                 counts=np.array(list(self.judgments.values())),
+                 audio_offset_ms=self.audio_offset * 1e3, visual_offset_ms=self.visual_offset * 1e3,
+                 frame_times_ms=np.asarray(stats.frame_times, dtype=np.float32) * 1e3,
+                 dropped_frames=stats.dropped)
+        return path
+
+    def stats_overlay(self, screen):
+        # 統計每半秒才重新計算與排版一次，平常直接貼上快取的文字
+        now = time.perf_counter()
+        if self.stats_text is None or now - self.stats_refreshed >= 0.5:
+            stats = self.scheduler.stats
+            fps, p50, p95, p99 = stats.summary(last=FRAME_RATE * 2)
+            font = pygame.font.Font(None, 24)
+            self.stats_text = font.render(
+                f"{fps:.0f} fps  p50 {p50:.1f}  p95 {p95:.1f}  p99 {p99:.1f} ms  dropped {stats.dropped}",
+                True, (0, 0, 0))
+            self.stats_refreshed = now
+        return self.stats_text, (screen.get_width() - self.stats_text.get_width() - 10, 10)
+
+    def overlays(self, screen):
+        """回傳這一幀要貼在圓圈上方的文字 [(surface, 位置)]"""
+        overlays = []
+        if self.last_judgment is not None:
+            overlays.append((judgment_text(self.last_judgment), (10, 10)))
+        if self.show_stats:
+            overlays.append(self.stats_overlay(screen))
+        return overlays
+
+    def dirty_region(self, screen, visible, overlays):
+        """合併出現、消失或被擊中的圓圈與變動文字的矩形，畫面沒有變化時回傳 None"""
+        drawn = set(visible.tolist())
+        if self.full_redraw:
+            rects = [screen.get_rect()]
+            self.full_redraw = False
+        else:
+            rects = self.chart.bounds(list(drawn.symmetric_difference(self.drawn)))
+        if overlays != self.drawn_overlays:
+            rects += [surface.get_rect(topleft=pos) for surface, pos in self.drawn_overlays + overlays]
+        self.drawn = drawn
+        self.drawn_overlays = overlays
+        if not rects:
+            return None
+        return rects[0].unionall(rects[1:]).clip(screen.get_rect())
+
+    def simulate(self, dt):
         if hasattr(self, 'running') and self.running:
-            self.pygame_widget.screen.fill((255, 255, 255))
+            self.clock.update()
+            self.expire_notes()
 
-            current_time = time.time() - self.start_time
-            for circle in self.circles:
-                if circle.time_to_show <= current_time and not circle.clicked:
-                    circle.draw(self.pygame_widget.screen)
+    def update_pygame(self):
+        if hasattr(self, 'running') and self.running:
+            screen = self.pygame_widget.screen
+            current_time = self.clock.time() - (self.audio_offset - self.visual_offset)
+            visible = self.timeline.advance(current_time + NOTE_APPROACH_TIME)
+            overlays = self.overlays(screen)
+            dirty = self.dirty_region(screen, visible, overlays)
+            if dirty is None:
+                return
+
+            # 只清空並重畫變動的範圍，範圍外的像素維持上一幀的內容
+            screen.set_clip(dirty)
+            screen.fill((255, 255, 255))
+            self.chart.draw(screen, visible)
+            screen.blits(overlays, doreturn=False)
+            screen.set_clip(None)
+
+            self.pygame_widget.update(QRect(dirty.x, dirty.y, dirty.width, dirty.height))
 
-            self.pygame_widget.update()
+    def closeEvent(self, event):
+        # 已關閉的視窗再次 close() 時不重複匯出本局紀錄
+        if self.running:
+            self.running = False
+            self.scheduler.stop()
+            self.clock.stop()
+            last, mean, worst = self.clock.drift_stats()
+            print(f"Audio clock drift: last {last:.1f} ms, mean {mean:.1f} ms, max {worst:.1f} ms")
+            self.export_session()
+            self.closed.emit()
+        super().closeEvent(event)
 
 if __name__ == '__main__':
+    # 帶參數執行時使用命令列工具，不開啟視窗
+    if len(sys.argv) > 1:
+        sys.exit(main_cli(sys.argv[1:]))
     app = QApplication(sys.argv)
     music_game_app = MusicGameApp()
     music_game_app.show()